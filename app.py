@@ -20,6 +20,9 @@ import flask_assets
 
 import identity
 import elections
+import refresh
+import storage
+import jobqueue
 
 # Read in environment variables for Heroku (flask-appconfig replacement)
 def read_environment(app):
@@ -27,17 +30,39 @@ def read_environment(app):
       if var.startswith('MPCV_'):
          var_without_prefix = var.replace('MPCV_', '')
          app.config[var_without_prefix] = val
-   print("S3 bucket name:", app.config['S3_BUCKET_NAME'])
+   # Flask-Caching and Flask want numbers for these
+   for var in ['CACHE_DEFAULT_TIMEOUT', 'CACHE_THRESHOLD', 'MAX_CONTENT_LENGTH']:
+      if var in app.config:
+         app.config[var] = int(app.config[var])
+   if app.config.get('STORAGE_BACKEND') == 'local':
+      print("Local storage directory:", app.config.get('STORAGE_DIR', 'tmp/storage'))
+   else:
+      print("S3 bucket name:", app.config.get('S3_BUCKET_NAME'))
+
+# The cache defaults to being in memory in each worker process. Set
+# MPCV_CACHE_TYPE=filesystem to share it between all the workers on a
+# machine, so only one of them has to warm it.
+def cache_config(app):
+   app.config.setdefault('CACHE_TYPE', 'simple')
+   if app.config['CACHE_TYPE'] in ['filesystem', 'FileSystemCache']:
+      app.config.setdefault('CACHE_DIR', 'tmp/cache')
+      # one entry per constituency, so need more than the default 500
+      app.config.setdefault('CACHE_THRESHOLD', 5000)
 
 app = flask.Flask('mpcv')
 app.debug = True
+# biggest upload we take, refused before any of it is read
+app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024
 read_environment(app)
+cache_config(app)
 mail = flask_mail.Mail(app)
-cache = flask_caching.Cache(app,config={'CACHE_TYPE': 'simple'})
+cache = flask_caching.Cache(app)
 flask_compress.Compress(app)
 assets = flask_assets.Environment(app)
 
 import lookups
+# so the job worker (see start_job_worker) makes thumbnails too
+import thumbnails
 
 # Log to stderr for Heroku
 stream_handler = logging.StreamHandler()
@@ -143,10 +168,16 @@ def look_for_postcode():
     flask.session['postcode'] = constituency['postcode']
     flask.session['constituency'] = constituency
 
-@app.before_request
-def set_thumbnail():
-    all_cvs = _cache_all_cvs()
-    flask.g.most_recent_thumbnail = all_cvs[0]['thumb']['url']
+# Default image for sharing pages on social media. This is a function
+# so it is only looked up by pages which use it, see bumf.html.
+@app.context_processor
+def most_recent_thumbnail():
+    def most_recent_thumbnail():
+        url = _cache_most_recent_thumbnail()
+        if url is None:
+            url = flask.url_for('static', filename='what-is-cv.png', _external=True)
+        return url
+    return { 'most_recent_thumbnail': most_recent_thumbnail }
 
 # Tracking events
 @app.before_request
@@ -155,6 +186,11 @@ def track_events_from_cookies():
         flask.g.emailed_candidates_track = flask.session['emailed_candidates_track']
         del flask.session['emailed_candidates_track']
 
+# Runs queued jobs, such as saving uploaded CVs and sending mail, in the background
+@app.before_first_request
+def start_job_worker():
+    jobqueue.start_worker(app.config)
+
 # When archiving an election with bin/archive-entire-election.sh
 @app.before_request
 def detect_archive_mode():
@@ -169,6 +205,13 @@ def detect_archive_mode():
 def error():
     return flask.render_template('error.html'), 500
 
+# Uploads bigger than MAX_CONTENT_LENGTH, go back to the form
+@app.errorhandler(413)
+def too_large(e):
+    flask.flash("Sorry! That file is too big, it can be at most {} Mb. Please try a smaller one, or contact us for help.".format(
+        app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)), 'danger')
+    return flask.redirect(flask.request.path)
+
 @app.route('/about')
 def about():
     return flask.render_template('about.html',
@@ -190,15 +233,25 @@ def exception():
 #####################################################################
 # Caches
 
-@cache.memoize(60 * 10)
+# These are refreshed in the background after 10 minutes, or as soon as
+# a CV is uploaded which changes them, see refresh.py
+
+@refresh.memoize(app.config, cache, 60 * 10, version=lambda: lookups.cvs_version(app.config))
 def _cache_all_cvs():
     return lookups.all_cvs_with_thumbnails(app.config)
 
-@cache.memoize(60 * 10)
+@refresh.memoize(app.config, cache, 60 * 10, version=lambda: lookups.cvs_version(app.config))
+def _cache_most_recent_thumbnail():
+    thumb = lookups.most_recent_thumbnail(app.config)
+    if thumb is None:
+        return None
+    return thumb['url']
+
+@refresh.memoize(app.config, cache, 60 * 10, version=lambda: lookups.cvs_version(app.config))
 def _cache_all_constituencies():
     return lookups.all_constituencies(app.config)
 
-@cache.memoize(60 * 10)
+@refresh.memoize(app.config, cache, 60 * 10, version=lambda constituency_id: lookups.constituency_version(app.config, constituency_id))
 def _cache_candidates_augmented(constituency_id):
     all_candidates = lookups.lookup_candidates(app.config, constituency_id)
     if 'error' in all_candidates:
@@ -228,7 +281,7 @@ def browse(view, size):
     all_cvs = _cache_all_cvs()
     all_constituencies = _cache_all_constituencies()
     cvs_got = len(all_cvs)
-    cvs_out_of = sum([ len(c) for c in all_constituencies ])
+    cvs_out_of = lookups.count_candidates(app.config)
 
     if view == 'recent':
         return flask.render_template('browse.html',
@@ -408,6 +461,16 @@ def show_cv(person_id):
             more_link=more_link
         )
 
+# CVs and thumbnails when they are kept in local storage, see storage.py.
+# In S3 they are public, so are downloaded from there instead.
+@app.route('/storage/<path:name>')
+def stored_file(name):
+    store = storage.get(app.config)
+    if not isinstance(store, storage.LocalStorage):
+        flask.abort(404)
+    directory, filename = store.public_path(name)
+    return flask.send_from_directory(directory, filename)
+
 
 #####################################################################
 # Uploading CVs
@@ -422,7 +485,7 @@ def upload_cv(person_id):
         return error()
 
     if flask.request.method == 'POST':
-        identity.send_upload_cv_confirmation(app, mail, candidate['id'], candidate['email'], candidate['name'])
+        identity.send_upload_cv_confirmation(app, candidate['id'], candidate['email'], candidate['name'])
         return flask.render_template("check_email.html", candidate=candidate)
 
     already_got = False
@@ -491,17 +554,16 @@ def upload_cv_upload(person_id, signature):
         return flask.redirect(flask.request.path)
 
     secure_filename = werkzeug.utils.secure_filename(f.filename)
-    data = f.read()
-    size = len(data)
-
-    print("saving CV to S3: candidate:", person_id, "uploaded file:", secure_filename, size, "bytes")
-    file_url = lookups.add_cv(app.config, person_id, data, secure_filename)
+    # Werkzeug has spooled large uploads to a temporary file, so stream
+    # from that rather than reading it all into memory
+    size = f.stream.seek(0, os.SEEK_END)
+    f.stream.seek(0)
 
-    # force reloading of all data for now, so CV appears in the redirect
-    with app.app_context():
-        cache.clear()
+    print("queueing CV for storage: candidate:", person_id, "uploaded file:", secure_filename, size, "bytes")
+    # the job also updates the caches which show the CV
+    lookups.queue_cv_upload(app.config, person_id, f.stream, secure_filename)
 
-    flask.flash("Thanks! Your CV has been successfully uploaded. It will take about half an hour to appear on the site.", 'success')
+    flask.flash("Thanks! Your CV has been successfully uploaded. It will appear on the site in a few seconds.", 'success')
     flask.flash("Friends who are also candidates? Please tell them to upload their CV too!", 'info')
     return flask.redirect("/about")
 
@@ -588,7 +650,7 @@ Yours sincerely,
             # prompt for signup again
             flask.session['dismiss'] = False
             # send the mail
-            identity.send_email_candidates(app, mail,
+            identity.send_email_candidates(app,
                 candidates_no_cv, from_email,
                 subject, message
             )
@@ -11,6 +11,7 @@ import inflect
 
 sys.path.append(os.getcwd())
 import app
+import bulkmail
 import identity
 import lookups
 
@@ -18,10 +19,12 @@ app.app.config['SERVER_NAME'] = 'cv.democracyclub.org.uk'
 
 p = inflect.engine()
 
-# Get list of all volunteers from S3
-subscribers = lookups.slow_updates_list(app.app.config)
+# Get list of all volunteers
+subscribers = lookups.updates_list(app.app.config)
 
-# Loop over them
+# Loop over them, making the mails
+messages = []
+postcodes = {}
 for subscriber in subscribers:
     # Only mail to ones we haven't mailed recently
     back_to = datetime.datetime.now() - datetime.timedelta(days=3)
@@ -122,13 +125,18 @@ P.P.S. To unsubscribe, reply to this email and just ask.
     print("DEBUG aborted just before send")
     sys.exit(1)
 
-    with app.app.app_context():
-        app.mail.send(msg)
-        print("mail sent!")
-        # Touch the timestamp so we don't mail them again until time passes
-        lookups.updates_join(app.app.config, subscriber['email'], subscriber['postcode'])
-        print("touched stamp!")
+    messages.append(msg)
+    postcodes[subscriber['email']] = subscriber['postcode']
 
     print("========================================")
 
 
+# Touch the timestamp so we don't mail them again until time passes
+def touch_stamp(msg):
+    email = msg.recipients[0]
+    lookups.updates_join(app.app.config, email, postcodes[email])
+    print("mail sent, touched stamp!", email)
+
+# Send them all
+with app.app.app_context():
+    bulkmail.send_all(app.app.config, app.mail, messages, sent=touch_stamp)
@@ -5,18 +5,25 @@ import os
 import collections
 
 import flask_mail
-import boto.s3.key
 
 sys.path.append(os.getcwd())
 import app
+import bulkmail
 import identity
 import lookups
 
 app.app.config['SERVER_NAME'] = 'cv.democracyclub.org.uk'
 
-mailed_hash = lookups._hash_by_prefix(app.app.config, "mailed/linkedin/")
+mailed_hash = lookups.linkedin_mailed(app.app.config)
+
+# record sent
+def record_sent(msg):
+    name, email = msg.recipients[0]
+    lookups.linkedin_mail_sent(app.app.config, person_ids[email])
 
 with app.app.app_context():
+    messages = []
+    person_ids = {}
     for constituency in lookups.all_constituencies(app.app.config):
         for candidate in constituency:
             if candidate['id'] in mailed_hash:
@@ -69,11 +76,8 @@ a Word or PDF document, and go here:
                     ]
                   )
 
-            app.mail.send(msg)
+            messages.append(msg)
+            person_ids[candidate['email']] = candidate['id']
 
-            # record sent
-            bucket = lookups._get_s3_bucket(app.app.config)
-            key = boto.s3.key.Key(bucket)
-            key.key = "mailed/linkedin/" + str(candidate['id']) + ".sent"
-            key.set_contents_from_string("sent")
+    bulkmail.send_all(app.app.config, app.mail, messages, sent=record_sent)
 
@@ -3,10 +3,7 @@
 import sys
 import os
 import csv
-import codecs
 import collections
-import requests
-import urllib.request
 
 sys.path.append(os.getcwd())
 import app
@@ -17,27 +14,25 @@ app.app.config['SERVER_NAME'] = 'cv.democracyclub.org.uk'
 
 with app.app.app_context():
 
-    url = lookups.candidates_csv_url()
-    stream = urllib.request.urlopen(url)
-    rows = csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
-    rows = lookups.augment_if_has_cv(app.app.config, list(rows))
+    candidates = lookups.stream_candidates(app.app.config)
+    candidates = lookups.augment_if_has_cv(app.app.config, candidates)
 
     fields = ['name', 'email', 'id', 'party', 'constituency', 'upload_url']
     writer = csv.DictWriter(sys.stdout, fields)
     writer.writeheader()
 
-    for row in rows:
-        if row['has_cv']:
+    for candidate in candidates:
+        if candidate['has_cv']:
             continue
 
         out = collections.OrderedDict()
-        out['name'] = row['name']
-        out['email'] = row['email']
-        out['id'] = row['id']
-        out['party'] = row['party_name']
-        out['constituency'] = row['post_label']
+        out['name'] = candidate['name']
+        out['email'] = candidate['email']
+        out['id'] = candidate['id']
+        out['party'] = candidate['party']
+        out['constituency'] = candidate['constituency_name']
 
-        link = identity.generate_upload_url(app.app.secret_key, row['id'])
+        link = identity.generate_upload_url(app.app.secret_key, candidate['id'])
         out['upload_url'] = link
 
         writer.writerow(out)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Makes the local table of postcode to Westminster constituency, which
+# lookup_postcode uses before asking the Democracy Club API. See
+# postcodetable.py.
+#
+# Download the ONS Postcode Directory (ONSPD, a .zip or its main .csv),
+# and the matching "Westminster Parliamentary Constituency names and
+# codes" CSV, from https://geoportal.statistics.gov.uk/ then run:
+#
+#   bin/make-postcode-table.py ONSPD.zip constituency-names.csv tmp/postcodes.table
+#
+# and set MPCV_POSTCODE_TABLE_PATH=tmp/postcodes.table
+
+import sys
+import os
+import io
+import csv
+import zipfile
+import argparse
+
+sys.path.append(os.getcwd())
+import postcodetable
+
+parser = argparse.ArgumentParser(description="Make the local postcode to constituency table.")
+parser.add_argument("postcodes", help="ONS Postcode Directory, .zip or .csv")
+parser.add_argument("names", help="CSV of constituency codes and names")
+parser.add_argument("output", help="table file to write")
+parser.add_argument("--postcode-column", default="pcds")
+parser.add_argument("--constituency-column", default="pcon")
+# elections API official_identifier is like "gss:E14000639"
+parser.add_argument("--identifier-prefix", default="gss:")
+args = parser.parse_args()
+
+# Returns a CSV reader of the postcodes, from inside the zip if it is one
+def open_postcodes(filename):
+    if not filename.endswith(".zip"):
+        return csv.DictReader(open(filename, encoding='utf-8-sig', newline=''))
+
+    archive = zipfile.ZipFile(filename)
+    # the main data file is by far the biggest CSV in it
+    member = max([ m for m in archive.infolist() if m.filename.lower().endswith(".csv") ], key=lambda m: m.file_size)
+    print("reading", member.filename)
+    return csv.DictReader(io.TextIOWrapper(archive.open(member), encoding='utf-8-sig', newline=''))
+
+# Read constituency names, columns are like PCON24CD and PCON24NM
+names = {}
+with open(args.names, encoding='utf-8-sig', newline='') as f:
+    rows = csv.DictReader(f)
+    code_column = [ c for c in rows.fieldnames if c.upper().endswith("CD") ][0]
+    name_column = [ c for c in rows.fieldnames if c.upper().endswith("NM") ][0]
+    for row in rows:
+        names[row[code_column]] = row[name_column]
+print("constituencies:", len(names))
+
+def postcodes():
+    skipped = 0
+    for row in open_postcodes(args.postcodes):
+        # postcodes no longer in use
+        if row.get('doterm'):
+            continue
+        code = row[args.constituency_column]
+        if code not in names:
+            skipped += 1
+            continue
+        yield row[args.postcode_column], args.identifier_prefix + code, names[code]
+    print("skipped postcodes not in a known constituency:", skipped)
+
+count = postcodetable.write(args.output, postcodes())
+print("postcodes written:", count)
@@ -6,20 +6,26 @@ import collections
 import datetime
 
 import flask_mail
-import boto.s3.key
 
 sys.path.append(os.getcwd())
 import app
+import bulkmail
 import identity
 import lookups
 
 app.app.config['SERVER_NAME'] = 'cv.democracyclub.org.uk'
 
-# Get list of when last sent
-last_sent_by_email = lookups.candidate_mail_last_sent(app.app.config)
+# Get who we've mailed recently
+back_to = datetime.datetime.utcnow() - datetime.timedelta(days=14)
+recently_mailed = lookups.candidates_mailed_since(app.app.config, back_to)
 
 
+# Record who we sent to so we don't mail them again until time passes
+def record_sent(msgs):
+    lookups.candidate_mail_sent(app.app.config, [ email for msg in msgs for name, email in msg.recipients ])
+
 with app.app.app_context():
+    messages = []
     for constituency in lookups.all_constituencies(app.app.config):
         for candidate in constituency:
             if candidate['id'] in [5819]:
@@ -31,12 +37,9 @@ with app.app.app_context():
                 continue
 
             # Only mail to ones we haven't mailed recently
-            if candidate['email'] in last_sent_by_email:
-                back_to = datetime.datetime.now() - datetime.timedelta(days=14)
-                last_sent = last_sent_by_email[candidate['email']]
-                if last_sent > back_to:
-                    print("skipping too recent", candidate['email'], last_sent, ">", back_to)
-                    continue
+            if candidate['email'].lower() in recently_mailed:
+                print("skipping too recent", candidate['email'])
+                continue
 
             link = identity.generate_upload_url(app.app.secret_key, candidate['id'])
 
@@ -75,6 +78,7 @@ http://cv.democracyclub.org.uk/
                         (candidate['name'], candidate['email'])
                     ]
                   )
-            app.mail.send(msg)
-            lookups.candidate_mail_sent(app.app.config, candidate['email'])
+            messages.append(msg)
+
+    bulkmail.send_all(app.app.config, app.mail, messages, sent_batch=record_sent)
 
@@ -0,0 +1,112 @@
+# Sending lots of emails at once, e.g. to every candidate or volunteer.
+
+# Calling mail.send for each message opens a new SMTP connection every
+# time, which is slow. Instead send_all sends a batch of messages down each
+# connection, and when the connection breaks or the server says to try
+# later (a 4xx code, e.g. because we're sending too fast), it waits a bit
+# and carries on with a new connection.
+
+import time
+import socket
+import smtplib
+
+BULK_MAIL_DEFAULTS = {
+    # messages sent down each SMTP connection, before making a new one
+    'MAIL_PER_CONNECTION': 50,
+    # times to retry a message which failed for a temporary reason
+    'MAIL_RETRIES': 3
+}
+
+def _setting(config, name):
+    return int(config.get(name, BULK_MAIL_DEFAULTS[name]))
+
+# Is the error one where trying again later, on a new connection, might work?
+def _temporary(e):
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+        ConnectionError, socket.timeout, socket.gaierror))
+
+# Raised from an error in a caller's callback, which isn't a mail failure
+class _CallbackFailed(Exception):
+    pass
+
+def _recipients(message):
+    return ", ".join(str(recipient) for recipient in message.recipients)
+
+# Takes the app config, the flask_mail.Mail and a list of flask_mail.Message.
+# Sends them all, calling sent(message), if given, after each one has gone,
+# and sent_batch(messages), if given, with those sent down each connection
+# once it is finished with, so they can be recorded all at once. An error
+# from either is raised straight away, and never makes us send a message
+# again. Must be called in an app context. Returns a list of (message,
+# exception) pairs of any which couldn't be sent, e.g. because the address
+# was refused; failed(message, exception), if given, is called as each
+# one fails, for callers which need them even if we stop part way.
+def send_all(config, mail, messages, sent=None, sent_batch=None, failed=None):
+    per_connection = _setting(config, 'MAIL_PER_CONNECTION')
+    retries = _setting(config, 'MAIL_RETRIES')
+
+    messages = list(messages)
+    failures = []
+    position = 0
+    attempts = 0
+    started = time.time()
+    while position < len(messages):
+        batch = []
+        try:
+            with mail.connect() as connection:
+                for message in messages[position:position + per_connection]:
+                    try:
+                        connection.send(message)
+                    except Exception as e:
+                        if _temporary(e):
+                            raise
+                        print("failed to send mail to", _recipients(message), e)
+                        failures.append((message, e))
+                        position += 1
+                        attempts = 0
+                        if failed is not None:
+                            try:
+                                failed(message, e)
+                            except Exception as callback_error:
+                                raise _CallbackFailed() from callback_error
+                        continue
+                    # it has gone, whatever happens next
+                    position += 1
+                    attempts = 0
+                    batch.append(message)
+                    if sent is not None:
+                        try:
+                            sent(message)
+                        except Exception as e:
+                            raise _CallbackFailed() from e
+        except _CallbackFailed as e:
+            raise e.__cause__
+        except Exception as e:
+            if not _temporary(e):
+                raise
+            # quitting the connection can fail after everything is sent
+            if position == len(messages):
+                break
+            attempts += 1
+            if attempts > retries:
+                print("giving up on mail to", _recipients(messages[position]), e)
+                failures.append((messages[position], e))
+                if failed is not None:
+                    failed(messages[position], e)
+                position += 1
+                attempts = 0
+            else:
+                print("temporary mail failure, trying again:", e)
+                # wait 1 second, then 2, 4...
+                time.sleep(2 ** (attempts - 1))
+        finally:
+            # including any sent before the connection broke
+            if batch and sent_batch is not None:
+                sent_batch(batch)
+
+    seconds = time.time() - started
+    print("sent {} of {} mails in {:.1f} seconds ({:.1f} a second)".format(
+        len(messages) - len(failures), len(messages), seconds, len(messages) / max(seconds, 0.001)))
+    return failures
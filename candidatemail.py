@@ -0,0 +1,47 @@
+# Log of when we've emailed candidates asking for their CV, so bulk
+# mailings (e.g. bin/parl.2017-06-08/01-all-candidates.py) don't mail
+# them too often. Kept in the local database.
+
+# Each batch of mails sent is also saved in storage (see
+# lookups.candidate_mail_sent), and the log is built from there when the
+# local database doesn't have it yet (see lookups.import_candidate_mail),
+# then kept up to date with batches saved since.
+# So asking who we've mailed recently is one query on an index, not a
+# listing of a file per candidate.
+
+import localdb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS candidate_mail (
+    email TEXT NOT NULL,
+    sent_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS candidate_mail_sent_at ON candidate_mail (sent_at, email);
+"""
+
+def _connect(config):
+    return localdb.connect(config, SCHEMA)
+
+# Records that we mailed a list of emails at a time (naive UTC datetime).
+# Any already recorded at that time are left alone.
+def add(config, emails, sent_at):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        conn.executemany("""INSERT INTO candidate_mail (email, sent_at) SELECT ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM candidate_mail WHERE sent_at = ? AND email = ?)""",
+            [ (email, sent_at.isoformat(), sent_at.isoformat(), email) for email in emails ])
+
+# Replaces the whole log with a list of (email, sent at) pairs.
+def replace(config, entries):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        conn.execute("DELETE FROM candidate_mail")
+        conn.executemany("INSERT INTO candidate_mail (email, sent_at) VALUES (?, ?)",
+            [ (email, sent_at.isoformat()) for email, sent_at in entries ])
+
+# Returns the set of emails we've mailed at or after a time (naive UTC
+# datetime), so anyone else can be mailed again.
+def mailed_since(config, since):
+    rows = _connect(config).execute("SELECT DISTINCT email FROM candidate_mail WHERE sent_at >= ?",
+        (since.isoformat(),)).fetchall()
+    return set(row['email'] for row in rows)
@@ -0,0 +1,99 @@
+# Compact, read only table of every candidate in the current election.
+
+# There are a few thousand candidates, and every worker process keeps
+# them all in memory, so we store them as small records rather than
+# dictionaries, with repeated strings (party, constituency) shared.
+
+import sys
+
+# The fields of each candidate, see lookups._candidate_table
+FIELDS = ('id', 'name', 'email', 'twitter', 'linkedin_url', 'party', 'constituency_id', 'constituency_name')
+
+# Fields which are the same for lots of candidates
+_INTERNED = ('party', 'constituency_id', 'constituency_name')
+
+# One candidate. Can be read like the dictionaries the rest of the code
+# uses, e.g. candidate['name'] or dict(candidate), but not changed.
+class Candidate:
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(FIELDS, values):
+            if field in _INTERNED and value is not None:
+                value = sys.intern(value)
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, field, value):
+        raise AttributeError("Candidate is read only")
+
+    def __reduce__(self):
+        return (Candidate, tuple(getattr(self, field) for field in FIELDS))
+
+    def __getitem__(self, field):
+        if field not in FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in FIELDS
+
+    def get(self, field, default=None):
+        if field not in FIELDS:
+            return default
+        return getattr(self, field)
+
+    def keys(self):
+        return FIELDS
+
+    def __repr__(self):
+        return "Candidate(" + repr(dict(self)) + ")"
+
+# Sort by surname (as best we can -- "Duncan Smith" won't work)
+# so it is same as on ballot paper. So can get used to it.
+def surname(candidate):
+    return candidate['name'].split(" ")[-1]
+
+# All the candidates, with indexes to find them by candidate id and by
+# constituency id. Sorted once when made, so constituencies come out
+# alphabetically by name, and candidates in ballot paper order.
+class CandidateTable:
+    __slots__ = ('rows', 'by_id', 'by_constituency')
+
+    # Takes an iterable of Candidate
+    def __init__(self, candidates):
+        candidates = list(candidates)
+        names = {}
+        for candidate in candidates:
+            names.setdefault(candidate.constituency_id, candidate.constituency_name)
+        self.rows = tuple(sorted(candidates,
+            key=lambda c: (names[c.constituency_id], c.constituency_id, surname(c))))
+
+        self.by_id = {}
+        self.by_constituency = {}
+        for row, candidate in enumerate(self.rows):
+            # XXX if a candidate is in twice, the last one wins, as it always has
+            self.by_id[candidate.id] = row
+            start, end = self.by_constituency.get(candidate.constituency_id, (row, row))
+            self.by_constituency[candidate.constituency_id] = (start, row + 1)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Returns the Candidate with the id, or None
+    def candidate(self, person_id):
+        row = self.by_id.get(person_id)
+        if row is None:
+            return None
+        return self.rows[row]
+
+    # Returns a tuple of the Candidates in a constituency in ballot
+    # paper order, or None
+    def constituency(self, constituency_id):
+        if constituency_id not in self.by_constituency:
+            return None
+        start, end = self.by_constituency[constituency_id]
+        return self.rows[start:end]
+
+    # Returns the ids of all the constituencies, alphabetically by name
+    def constituency_ids(self):
+        return self.by_constituency.keys()
@@ -1,48 +1,64 @@
 #!/usr/bin/env python3
 
-import os
-import subprocess
-import traceback
+# Makes thumbnails of CVs.
+#
+#   ./cron.py         - makes any missing thumbnails, run every so often
+#   ./cron.py worker  - runs for ever, making thumbnails as CVs are
+#                       uploaded (and any other queued jobs). The web
+#                       processes do this anyway, so only needed to run
+#                       them without the web server. Must be on
+#                       the same machine as the web server, as the job
+#                       queue is in the local database.
+
 import sys
 
 import flask_mail
-import PIL.Image
 
 import lookups
+import jobqueue
+import thumbnails
 import app
 
+# Takes a list of (CV or thumbnail, error) pairs, e.g. from
+# thumbnails.make_thumbnails, and emails us about them all at once.
+def send_failures(failures):
+    body = "\n\n".join("Person {} ({}):\n{}".format(cv['person_id'], cv['url'], error) for cv, error in failures)
+    msg = flask_mail.Message(body=body,
+            subject="Failed to make {} thumbs".format(len(failures)),
+            sender=("Democracy Club CV", "cv@democracyclub.org.uk"),
+            recipients=[("Democracy Club CV", "cv@democracyclub.org.uk")]
+          )
+    with app.app.app_context():
+        app.mail.send(msg)
+
+# Safety net, for anything the worker missed
 def gen_thumbs():
+    # catch anything the key index missed, e.g. uploads on another machine
+    lookups.reconcile_key_index(app.app.config, "cvs/")
+    lookups.reconcile_key_index(app.app.config, "thumbs/")
+
     # find all the CVs with out of date thumbnail
     cvs_bad_thumbs = lookups.all_cvs_bad_thumbnails(app.app.config)
     for x in cvs_bad_thumbs:
         print("cron missing thumb:", x)
-        filename = "tmp/{0}.png".format(x["person_id"])
-
-        # generate thumbnail with phantom
-        try:
-            subprocess.check_call(["phantomjs", "screenshot.js", x["url"], filename])
-            # make a JPEG, they're smaller
-            img = PIL.Image.open(filename)
-            # remove alpha channel, which JPEG doesn't support
-            img = img.convert("RGB")
-            img.save(filename + ".jpg", option='optimize')
-            # add the thumbnail to S3
-            lookups.add_thumb(app.app.config, filename + ".jpg", x['name'].replace("cvs/", "thumbs/") + ".jpg", extension="jpg")
-            os.remove(filename)
-            os.remove(filename + ".jpg")
-        except subprocess.CalledProcessError:
-            print("Failed to make thumb for person ", str(x["person_id"]))
-            print(traceback.format_exc())
-            msg = flask_mail.Message(body=traceback.format_exc(),
-                    subject="Failed to make thumb for person " + str(x["person_id"]),
-                    sender=("Democracy Club CV", "cv@democracyclub.org.uk"),
-                    recipients=[("Democracy Club CV", "cv@democracyclub.org.uk")]
-                  )
-            with app.app.app_context():
-                app.mail.send(msg)
-
-
-
-
-# generate missing thumbnails
-gen_thumbs()
+
+    failures = thumbnails.make_thumbnails(app.app.config, cvs_bad_thumbs)
+
+    # and the other sizes and formats of any which don't have them
+    for thumb in lookups.all_thumbs_missing_variants(app.app.config):
+        print("cron missing thumb variants:", thumb)
+        error = thumbnails.make_missing_variants(app.app.config, thumb)
+        if error is not None:
+            print(error)
+            failures.append((thumb, error))
+
+    if failures:
+        send_failures(failures)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["worker"]:
+        jobqueue.work(app.app.config)
+    else:
+        # generate missing thumbnails
+        gen_thumbs()
@@ -0,0 +1,90 @@
+# HTTP calls to other Democracy Club APIs.
+
+# Keeps one pooled requests.Session per process, so connections (and TLS)
+# are reused. Every call has a timeout, so a slow API can't hold up a web
+# worker for ever, and retries briefly on errors which are usually
+# temporary. If an API keeps failing, a circuit breaker stops us calling it
+# at all for a while, so we fail fast instead of waiting on it each time.
+
+import os
+import time
+import threading
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+# (connect, read) timeouts in seconds for each API we call. For streamed
+# responses the read timeout is the longest wait for the next bytes.
+TIMEOUTS = {
+    'elections': (3.05, 5),
+    'candidates': (3.05, 30)
+}
+
+# How many failures in a row before we stop calling an API, and for how long
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60
+
+USER_AGENT = "Democracy Club CVs/1.0"
+
+# Raised instead of calling an API which has been failing
+class Unavailable(Exception):
+    pass
+
+_session = (None, None)
+_session_lock = threading.Lock()
+
+# endpoint -> (failures in a row, time we can try again)
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# Returns the requests.Session for this process, making it if needed.
+# Sessions aren't shared across fork, as the pooled sockets would be.
+def session():
+    global _session
+    with _session_lock:
+        pid, s = _session
+        if pid != os.getpid():
+            retry = urllib3.util.retry.Retry(total=2, connect=2, read=1, backoff_factor=0.3,
+                status_forcelist=(500, 502, 503, 504), allowed_methods=['GET'], raise_on_status=False)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+            s = requests.Session()
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            s.headers["user-agent"] = USER_AGENT
+            _session = (os.getpid(), s)
+        return s
+
+def _check_breaker(endpoint):
+    with _breakers_lock:
+        failures, retry_at = _breakers.get(endpoint, (0, 0))
+        if failures >= BREAKER_FAILURES:
+            if time.time() < retry_at:
+                raise Unavailable(endpoint + " API is failing, not calling it for now")
+            # let one call through to see if it is back
+            _breakers[endpoint] = (failures, time.time() + BREAKER_COOLDOWN)
+
+def _record(endpoint, ok):
+    with _breakers_lock:
+        if ok:
+            _breakers.pop(endpoint, None)
+            return
+        failures = _breakers.get(endpoint, (0, 0))[0] + 1
+        if failures == BREAKER_FAILURES:
+            print("circuit breaker open for", endpoint, "API")
+        _breakers[endpoint] = (failures, time.time() + BREAKER_COOLDOWN)
+
+# Like requests.get, but for one of the APIs in TIMEOUTS. Raises Unavailable
+# if the API has been failing, or a requests.RequestException (e.g. a
+# timeout) if this call fails. Server errors are returned as responses, but
+# count as failures for the circuit breaker.
+def get(endpoint, url, **kwargs):
+    _check_breaker(endpoint)
+    kwargs.setdefault('timeout', TIMEOUTS[endpoint])
+    try:
+        r = session().get(url, **kwargs)
+    except requests.RequestException:
+        _record(endpoint, False)
+        raise
+    _record(endpoint, r.status_code < 500)
+    return r
@@ -8,6 +8,8 @@ import flask_mail
 import hmac
 import hashlib
 
+import outbox
+
 # Given the application's secret key, and a democracy person identifier,
 # returns a token suitable for emailing to them to authenticate themselves.
 def sign_person_id(secret_key, person_id):
@@ -60,7 +62,7 @@ UPLOAD_CV_MESSAGE = textwrap.dedent("""\
     (we were behind TheyWorkForYou)
 """)
 
-def send_upload_cv_confirmation(app, mail, person_id, to_email, to_name):
+def send_upload_cv_confirmation(app, person_id, to_email, to_name):
     to_email = map_to_email(app, to_email)
 
     link = generate_upload_url(app.secret_key, person_id)
@@ -79,7 +81,7 @@ def send_upload_cv_confirmation(app, mail, person_id, to_email, to_name):
             recipients=[(to_name, to_email)]
           )
 
-    mail.send(msg)
+    outbox.send(app.config, msg)
 
 
 CONSTITUENT_MAIL_MESSAGE = textwrap.dedent("""\
@@ -94,7 +96,7 @@ CONSTITUENT_MAIL_MESSAGE = textwrap.dedent("""\
     Or reply and attach it. A Word document or a PDF is perfect!
 """)
 
-def send_email_candidates(app, mail, candidates, from_email, subject, message):
+def send_email_candidates(app, candidates, from_email, subject, message):
     for candidate in candidates:
 
         person_id = candidate['id']
@@ -117,6 +119,5 @@ def send_email_candidates(app, mail, candidates, from_email, subject, message):
                 recipients=[(to_name, to_email)]
               )
 
-        mail.send(msg)
-
+        outbox.send(app.config, msg)
 
@@ -0,0 +1,192 @@
+# Queue of slow jobs, kept in the local database so they survive restarts.
+
+# Web requests add jobs with enqueue and return straight away. A background
+# thread in each worker process (see start_worker) takes them off the
+# queue and runs them, retrying later if they fail. Jobs are claimed for a
+# while before they run, so only one process runs each one; if it dies
+# part way through, another runs the job again once the claim runs out.
+# So a job must be safe to run twice.
+#
+# A process only runs the kinds of job it has handlers for, e.g. the web
+# processes make thumbnails because app.py imports thumbnails.py. Some
+# kinds are quicker done many at once, e.g. sending mail down one SMTP
+# connection; their handlers get every job of that kind which is due.
+#
+# With JOB_QUEUE_EAGER set, or when TESTING, jobs this process has a
+# handler for run as soon as they are added instead, in the same thread,
+# unless the handler says they are too slow for that.
+
+import os
+import json
+import time
+import threading
+import traceback
+
+import localdb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'waiting',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    claimed_until REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_waiting ON jobs (state, run_after);
+"""
+
+# How long a job can run before another process may try it again
+CLAIM_TIMEOUT = 60 * 10
+
+# After this many failures a job is left in the table as 'failed'
+MAX_ATTEMPTS = 8
+
+# Seconds between checks for new jobs from other processes
+POLL_INTERVAL = 5
+
+# Most jobs given to a batch handler at once
+BATCH_SIZE = 200
+
+# kind -> function taking the app config and the job's payload
+_handlers = {}
+# kind -> function taking the app config and a list of payloads
+_batch_handlers = {}
+# kinds which are always queued, even when eager
+_never_eager = set()
+
+_wake = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+def _connect(config):
+    return localdb.connect(config, SCHEMA)
+
+# Decorator, use like @jobqueue.handler("add_cv") on a function which
+# takes the app config and a payload, and does the job. With eager=False,
+# the jobs are queued even when eager, e.g. as they take too long to wait
+# for, or need programs which tests don't have.
+def handler(kind, eager=True):
+    def decorator(f):
+        _handlers[kind] = f
+        if not eager:
+            _never_eager.add(kind)
+        return f
+    return decorator
+
+# Decorator, like handler, for a function which takes the app config and a
+# list of payloads, and does all those jobs. Returns a list with, for each
+# payload in order, None if it is done, or a description of the error if
+# it should be tried again later.
+def batch_handler(kind):
+    def decorator(f):
+        _batch_handlers[kind] = f
+        return f
+    return decorator
+
+def _eager(config):
+    return bool(config.get('JOB_QUEUE_EAGER') or config.get('TESTING'))
+
+# Adds a job to the queue. The payload is anything which can be JSON. Returns
+# the job's id.
+def enqueue(config, kind, payload):
+    if _eager(config) and kind in _handlers and kind not in _never_eager:
+        _handlers[kind](config, payload)
+        return None
+    if _eager(config) and kind in _batch_handlers:
+        error, = _batch_handlers[kind](config, [payload])
+        if error is not None:
+            raise Exception(error)
+        return None
+
+    now = time.time()
+    cursor = _connect(config).execute("INSERT INTO jobs (kind, payload, run_after, created) VALUES (?, ?, ?, ?)",
+        (kind, json.dumps(payload), now, now))
+    _wake.set()
+    return cursor.lastrowid
+
+# Takes the next job which is due, which we have a handler for, and which
+# isn't claimed by anyone else, along with any others of the same kind
+# which are due, if it has a batch handler. Returns a list of their rows,
+# empty if there aren't any.
+def _claim(config):
+    conn = _connect(config)
+    now = time.time()
+    kinds = list(_handlers) + list(_batch_handlers)
+    with localdb.transaction(conn):
+        job = conn.execute("""SELECT * FROM jobs WHERE state = 'waiting' AND run_after <= ? AND claimed_until < ?
+            AND kind IN (""" + ",".join("?" * len(kinds)) + """)
+            ORDER BY run_after LIMIT 1""", [now, now] + kinds).fetchone()
+        if job is None:
+            return []
+        jobs = [job]
+        if job['kind'] in _batch_handlers:
+            jobs = conn.execute("""SELECT * FROM jobs WHERE state = 'waiting' AND run_after <= ? AND claimed_until < ?
+                AND kind = ? ORDER BY run_after LIMIT ?""", (now, now, job['kind'], BATCH_SIZE)).fetchall()
+        conn.executemany("UPDATE jobs SET claimed_until = ?, attempts = attempts + 1 WHERE id = ?",
+            [ (now + CLAIM_TIMEOUT, job['id']) for job in jobs ])
+    return jobs
+
+def _failed(config, job, error):
+    attempts = job['attempts'] + 1
+    if attempts >= MAX_ATTEMPTS:
+        print("job", job['id'], job['kind'], "failed for good:", error)
+        state, run_after = 'failed', time.time()
+    else:
+        # back off, 30 seconds, then 1 minute, 2 minutes...
+        state, run_after = 'waiting', time.time() + 30 * 2 ** (attempts - 1)
+    _connect(config).execute("UPDATE jobs SET state = ?, run_after = ?, claimed_until = 0, last_error = ? WHERE id = ?",
+        (state, run_after, error, job['id']))
+
+# Runs jobs until there are none due. Returns how many were run.
+def run_pending(config):
+    count = 0
+    while True:
+        jobs = _claim(config)
+        if not jobs:
+            return count
+        kind = jobs[0]['kind']
+        payloads = [ json.loads(job['payload']) for job in jobs ]
+        try:
+            if kind in _batch_handlers:
+                errors = _batch_handlers[kind](config, payloads)
+            else:
+                _handlers[kind](config, payloads[0])
+                errors = [None]
+        except Exception:
+            traceback.print_exc()
+            errors = [traceback.format_exc()] * len(jobs)
+
+        for job, error in zip(jobs, errors):
+            if error is None:
+                _connect(config).execute("DELETE FROM jobs WHERE id = ?", (job['id'],))
+            else:
+                print("job", job['id'], kind, "failed")
+                _failed(config, job, error)
+        count += len(jobs)
+
+# Starts the thread which runs jobs in this process, if it isn't running.
+def start_worker(config):
+    global _worker
+    if _eager(config):
+        return
+    with _worker_lock:
+        # threads don't survive fork, so check it is ours
+        if _worker is not None and _worker[0] == os.getpid():
+            return
+        thread = threading.Thread(target=work, args=(config,), daemon=True)
+        thread.start()
+        _worker = (os.getpid(), thread)
+
+# Runs jobs for ever, as they arrive.
+def work(config):
+    while True:
+        try:
+            run_pending(config)
+        except Exception:
+            traceback.print_exc()
+        _wake.wait(POLL_INTERVAL)
+        _wake.clear()
@@ -0,0 +1,137 @@
+# Index of the S3 keys for CVs and thumbnails, kept in the local database
+# so every worker process shares it.
+
+# New uploads are added to it as they happen, and it is occasionally
+# reconciled against a full listing of the bucket (see lookups.py), to
+# pick up changes made elsewhere.
+
+import time
+import datetime
+import collections
+
+import localdb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS key_index (
+    prefix TEXT NOT NULL,
+    person_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    created TEXT NOT NULL,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (prefix, person_id)
+);
+CREATE TABLE IF NOT EXISTS key_index_status (
+    prefix TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    reconciled_at REAL,
+    lease_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+# (database, prefix) -> (version, hash) of what this process last read
+_loaded = {}
+
+def _connect(config):
+    return localdb.connect(config, SCHEMA)
+
+def _bump_version(conn, prefix):
+    conn.execute("INSERT OR IGNORE INTO key_index_status (prefix) VALUES (?)", (prefix,))
+    conn.execute("UPDATE key_index_status SET version = version + 1 WHERE prefix = ?", (prefix,))
+
+# Returns a number which changes whenever the index for the prefix changes.
+# Cheap, so can be used to check if something built from the index is
+# out of date. Also works for any other tag passed to bump.
+def version(config, prefix):
+    row = _connect(config).execute("SELECT version FROM key_index_status WHERE prefix = ?", (prefix,)).fetchone()
+    if row is None:
+        return 0
+    return row['version']
+
+# Changes the version of a tag, e.g. "constituency/<id>", to tell every
+# worker process that things built from it are out of date.
+def bump(config, tag):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        _bump_version(conn, tag)
+
+# Returns how many seconds ago the prefix was last reconciled against
+# S3, or None if it never has been.
+def reconciled_age(config, prefix):
+    row = _connect(config).execute("SELECT reconciled_at FROM key_index_status WHERE prefix = ?", (prefix,)).fetchone()
+    if row is None or row['reconciled_at'] is None:
+        return None
+    return time.time() - row['reconciled_at']
+
+# Try to become the one process which reconciles the prefix. Returns True
+# if we got it, in which case nobody else will for lease seconds.
+def claim_reconcile(config, prefix, lease):
+    conn = _connect(config)
+    now = time.time()
+    with localdb.transaction(conn):
+        conn.execute("INSERT OR IGNORE INTO key_index_status (prefix) VALUES (?)", (prefix,))
+        cursor = conn.execute("UPDATE key_index_status SET lease_until = ? WHERE prefix = ? AND lease_until < ?",
+            (now + lease, prefix, now))
+    return cursor.rowcount == 1
+
+# Gives up our claim to reconcile the prefix, e.g. because listing S3 failed,
+# so another process can try straight away.
+def release_reconcile(config, prefix):
+    _connect(config).execute("UPDATE key_index_status SET lease_until = 0 WHERE prefix = ?", (prefix,))
+
+# Takes an entry for a new S3 key, with fields as in hash_by_prefix, and
+# puts it in the index as the person's most recent key.
+def add(config, prefix, entry):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        conn.execute("""INSERT INTO key_index (prefix, person_id, name, url, last_modified, created, indexed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (prefix, person_id) DO UPDATE SET
+                name = excluded.name, url = excluded.url,
+                last_modified = excluded.last_modified, indexed_at = excluded.indexed_at""",
+            (prefix, entry['person_id'], entry['name'], entry['url'],
+                entry['last_modified'].isoformat(), entry['created'].isoformat(), time.time()))
+        _bump_version(conn, prefix)
+
+# Replaces the index for the prefix with entries from a full listing of S3,
+# a dictionary from person_id as returned by hash_by_prefix. Anything added
+# since the listing began is kept, as the listing may have missed it.
+def replace(config, prefix, entries, listing_started):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        conn.execute("DELETE FROM key_index WHERE prefix = ? AND indexed_at < ?", (prefix, listing_started))
+        conn.executemany("""INSERT OR IGNORE INTO key_index (prefix, person_id, name, url, last_modified, created, indexed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [ (prefix, entry['person_id'], entry['name'], entry['url'],
+                entry['last_modified'].isoformat(), entry['created'].isoformat(), listing_started)
+              for entry in entries.values() ])
+        _bump_version(conn, prefix)
+        conn.execute("UPDATE key_index_status SET reconciled_at = ?, lease_until = 0 WHERE prefix = ?", (time.time(), prefix))
+
+# Given a prefix, returns a hash from integer person_id to a dictionary about
+# their most recent key, ordered by reverse time. Fields are as documented in
+# lookups._hash_by_prefix. Only reads the database when it has changed since
+# this process last looked.
+#
+# The hash and its dictionaries are shared by every caller until the index
+# changes, so don't change them; copy any you want to add fields to.
+def hash_by_prefix(config, prefix):
+    current_version = version(config, prefix)
+    loaded_key = (localdb.db_path(config), prefix)
+
+    if loaded_key not in _loaded or _loaded[loaded_key][0] != current_version:
+        rows = _connect(config).execute("""SELECT person_id, name, url, last_modified, created
+            FROM key_index WHERE prefix = ? ORDER BY last_modified DESC""", (prefix,)).fetchall()
+        result = collections.OrderedDict()
+        for row in rows:
+            result[row['person_id']] = {
+                'name': row['name'],
+                'url': row['url'],
+                'last_modified': datetime.datetime.fromisoformat(row['last_modified']),
+                'created': datetime.datetime.fromisoformat(row['created']),
+                'person_id': row['person_id']
+            }
+        _loaded[loaded_key] = (current_version, result)
+
+    return _loaded[loaded_key][1]
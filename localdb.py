@@ -0,0 +1,79 @@
+# Local SQLite database, shared by all the worker processes on one machine.
+
+# General policy: S3 is still where everything important lives. The
+# local database holds indexes of it, so that requests don't have to
+# wait for S3, and can be thrown away and rebuilt at any time.
+
+import os
+import json
+import sqlite3
+import threading
+import contextlib
+
+_local = threading.local()
+
+# Returns a SQLite connection to the database at LOCAL_DB_PATH in the config,
+# creating it if needed. Connections are per thread and per process, as
+# SQLite connections can't be shared between them. The schema is a string of
+# SQL statements which make the tables the caller uses, e.g. CREATE TABLE IF
+# NOT EXISTS; it is run once per connection.
+def connect(config, schema=None):
+    path = db_path(config)
+
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conns = {}
+
+    if path not in _local.conns:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # autocommit, we start transactions ourselves with transaction()
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # lets readers carry on while another process writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conns[path] = (conn, set())
+
+    conn, schemas = _local.conns[path]
+    if schema is not None and schema not in schemas:
+        conn.executescript(schema)
+        schemas.add(schema)
+
+    return conn
+
+def db_path(config):
+    return config.get('LOCAL_DB_PATH', 'tmp/mpcv.sqlite')
+
+# Use as "with localdb.transaction(conn):" to make several statements
+# atomic. Takes the write lock straight away, so two processes doing
+# read-then-write can't interleave.
+@contextlib.contextmanager
+def transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+VALUES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS local_values (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Returns a small value saved with set_value, or None if there isn't one.
+def get_value(config, name):
+    row = connect(config, VALUES_SCHEMA).execute("SELECT value FROM local_values WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row['value'])
+
+# Saves a small value (anything which can be JSON) under a name.
+def set_value(config, name, value):
+    connect(config, VALUES_SCHEMA).execute("INSERT OR REPLACE INTO local_values (name, value) VALUES (?, ?)",
+        (name, json.dumps(value)))
@@ -4,6 +4,7 @@
 # just the fields we're using. This is so having test ones
 # is easier.
 
+import os
 import requests
 import json
 import datetime
@@ -12,29 +13,32 @@ import collections
 import csv
 import io
 import datetime
+import time
+import tempfile
+import shutil
+import threading
+import concurrent.futures
 
 import app
 import elections
+import httpclient
+import jobqueue
+import localdb
+import keyindex
+import postcodetable
+import refresh
+import storage
+import subscribers
+import candidatetable
+import candidatemail
 
-import boto.s3.connection
-import boto.s3.key
-import boto.utils
 
 ###################################################################
 # General helpers
 
-conn = None
-def _get_s3_bucket(config):
-    global conn
-    if not conn:
-        conn = boto.s3.connection.S3Connection(
-            config.get('S3_ACCESS_KEY_ID'),
-            config.get('S3_SECRET_ACCESS_KEY')
-        )
-
-    bucket_name = config.get('S3_BUCKET_NAME')
-    bucket = conn.get_bucket(bucket_name)
-    return bucket
+# Returns where our files are kept, see storage.py.
+def _get_storage(config):
+    return storage.get(config)
 
 
 ###################################################################
@@ -44,45 +48,146 @@ def _get_s3_bucket(config):
 #   error - with a user friendly message, if the lookup failed
 #   id - the mySociety identifier of the constituency
 #   name - the text name of the constituency
+# Uses the local postcode table if there is one, and remembers answers
+# from the API for a while, see _cached_postcode.
 def lookup_postcode(postcode):
     canon_postcode = postcode.upper().strip().replace(" ", "")
     if canon_postcode in ['ZZ99ZZ']:
         return { 'id': "8888888", 'name': "Democracy Club Test Constituency", 'postcode': 'ZZ9 9ZZ' }
 
-    headers = {"user-agent": "Democracy Club CVs/1.0"}
+    config = app.app.config
+    constituency = postcodetable.lookup(config, canon_postcode)
+    if constituency is not None:
+        constituency_id, name = constituency
+        return { 'id': constituency_id, 'name': name, 'postcode': canon_postcode }
+
+    return _remembered_lookup(config, canon_postcode, _lookup_postcode_remote)
+
+# Takes a function which looks up a postcode, returning a result and how
+# long to cache it for, as _lookup_postcode_remote. Calls it, unless we
+# remember the answer.
+def _remembered_lookup(config, canon_postcode, fetch):
+    result = _cached_postcode(config, canon_postcode)
+    if result is None:
+        result, cache_for = fetch(canon_postcode)
+        if cache_for:
+            _cache_postcode(config, canon_postcode, result, int(config.get(cache_for, POSTCODE_CACHE_DEFAULTS[cache_for])))
+
+    return dict(result)
+
+ELECTIONS_API_URL = "https://elections.democracyclub.org.uk/api/elections/"
+
+# Asks the Democracy Club elections API. Returns the result as for
+# lookup_postcode, and the name of the config setting for how long it
+# can be cached, or None if it mustn't be (e.g. because the API is broken).
+def _lookup_postcode_remote(canon_postcode):
+    try:
+        r = httpclient.get('elections', ELECTIONS_API_URL, params={'postcode':canon_postcode})
+    except (httpclient.Unavailable, requests.RequestException):
+        return { "error": "Sorry, we couldn't look up postcodes just now. Please try again in a few minutes." }, None
+    # separately, as requests' JSONDecodeError is also a RequestException
     try:
-        data = requests.get("https://elections.democracyclub.org.uk/api/elections/", params={'postcode':canon_postcode}, headers=headers).json()
-    except json.decoder.JSONDecodeError:
-        return { "error": "Postcode is not valid." }
+        data = r.json()
+    except (json.decoder.JSONDecodeError, requests.JSONDecodeError):
+        return { "error": "Postcode is not valid." }, None
 
     # Error response method varies, so we check three different ways
     if "error" in data:
-        return data
+        return data, None
     if "detail" in data:
         if data["detail"] == "Invalid postcode":
-            return { "error": "Postcode is not valid." }
-        return { "error": data["detail"] }
+            return { "error": "Postcode is not valid." }, 'POSTCODE_CACHE_INVALID_TTL'
+        return { "error": data["detail"] }, None
     if "results" not in data:
-        return { "error": "Postcode not properly recognised" }
+        return { "error": "Postcode not properly recognised" }, None
 
     for election in data["results"]:
         if election["group"] == elections.current_election:
             if election["division"]["division_type"] != "WMC":
-                return { "error": "Internal error: Unexpectedly not Westminster election" }
+                return { "error": "Internal error: Unexpectedly not Westminster election" }, None
             constituency_id = election["division"]["official_identifier"]
             return {
                 'id': constituency_id,
                 'name': election["division"]["name"],
                 'postcode': canon_postcode
-            }
-
-    return { "error": "Internal error: Election not found" }
-
-# Returns a pair of hashes of data from Democracy Club Candidates.
-#   by_candidate_id - maps from person id to dictionary about candidate
-#   by_constituency_id - maps from constituency id to array of dictionaries about candidate
+            }, 'POSTCODE_CACHE_TTL'
+
+    return { "error": "Internal error: Election not found" }, None
+
+POSTCODE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS postcode_cache (
+    election TEXT NOT NULL,
+    postcode TEXT NOT NULL,
+    result TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (election, postcode)
+);
+CREATE INDEX IF NOT EXISTS postcode_cache_expires ON postcode_cache (expires);
+"""
+
+POSTCODE_CACHE_DEFAULTS = {
+    'POSTCODE_CACHE_SIZE': 10000,
+    'POSTCODE_CACHE_TTL': 60 * 60 * 24,
+    'POSTCODE_CACHE_INVALID_TTL': 60 * 60,
+    'POSTCODE_CACHE_PERSIST': True
+}
+
+# Most recently used postcode lookups in this process, from (election,
+# canonical postcode) to (expiry time, result). Also saved in the local
+# database, unless POSTCODE_CACHE_PERSIST is set to empty.
+_postcode_cache = collections.OrderedDict()
+_postcode_cache_lock = threading.Lock()
+
+def _postcode_cache_persist(config):
+    return config.get('POSTCODE_CACHE_PERSIST', POSTCODE_CACHE_DEFAULTS['POSTCODE_CACHE_PERSIST'])
+
+# Returns the remembered result for the postcode, or None
+def _cached_postcode(config, canon_postcode):
+    key = (elections.current_election, canon_postcode)
+    now = time.time()
+
+    with _postcode_cache_lock:
+        if key in _postcode_cache:
+            expires, result = _postcode_cache[key]
+            if expires > now:
+                _postcode_cache.move_to_end(key)
+                return result
+            del _postcode_cache[key]
+
+    if _postcode_cache_persist(config):
+        row = localdb.connect(config, POSTCODE_CACHE_SCHEMA).execute(
+            "SELECT result, expires FROM postcode_cache WHERE election = ? AND postcode = ? AND expires > ?",
+            (key[0], key[1], now)).fetchone()
+        if row is not None:
+            result = json.loads(row['result'])
+            _remember_postcode(config, key, row['expires'], result)
+            return result
+
+    return None
+
+def _cache_postcode(config, canon_postcode, result, ttl):
+    key = (elections.current_election, canon_postcode)
+    expires = time.time() + ttl
+    _remember_postcode(config, key, expires, result)
+
+    if _postcode_cache_persist(config):
+        conn = localdb.connect(config, POSTCODE_CACHE_SCHEMA)
+        with localdb.transaction(conn):
+            conn.execute("DELETE FROM postcode_cache WHERE expires < ?", (time.time(),))
+            conn.execute("INSERT OR REPLACE INTO postcode_cache (election, postcode, result, expires) VALUES (?, ?, ?, ?)",
+                (key[0], key[1], json.dumps(result), expires))
+
+def _remember_postcode(config, key, expires, result):
+    with _postcode_cache_lock:
+        _postcode_cache[key] = (expires, result)
+        _postcode_cache.move_to_end(key)
+        while len(_postcode_cache) > int(config.get('POSTCODE_CACHE_SIZE', POSTCODE_CACHE_DEFAULTS['POSTCODE_CACHE_SIZE'])):
+            _postcode_cache.popitem(last=False)
+
+# Returns a candidatetable.CandidateTable of data from Democracy Club Candidates,
+# which can find candidates by id and by constituency id.
 #
-# The fields in the dictionaries about each candidate are:
+# The fields about each candidate are:
 #   id - the mySociety person_id of the candidate
 #   name - name of the candidate
 #   email - email address of the candidate (if known)
@@ -91,75 +196,137 @@ def lookup_postcode(postcode):
 #   party - political party name of the candidate
 #   constituency_id - identifier of constituency
 #   constituency_name - name of constituency
-@app.cache.memoize(60 * 60)
-def _hashes_of_candidates(config):
-    print("warming cache _hashes_of_candidates")
-
-    by_candidate_id = {}
-    by_constituency_id = collections.defaultdict(list)
-
-    rows = _fetch_candidates(config)
+@refresh.memoize(app.app.config, app.cache, 60 * 60)
+def _candidate_table(config):
+    global _last_candidates
+    print("warming cache _candidate_table")
+
+    validators, table = _last_candidates
+    rows, validators = _fetch_candidates(config, validators)
+    if rows is None:
+        print("candidates haven't changed")
+        return table
+
+    table = candidatetable.CandidateTable(_candidates_from_rows(rows))
+    _last_candidates = (validators, table)
+    return table
+
+# What this process last got from Democracy Club Candidates, so we can ask
+# for the CSV file only if it has changed. Pair of validators (as returned
+# by _fetch_candidates) and the table made from them.
+_last_candidates = ({}, None)
+
+# Returns an iterator of every candidate, as candidatetable.Candidate,
+# read as they arrive from Democracy Club Candidates. For scripts which
+# go through them all once.
+def stream_candidates(config):
+    rows, _ = _fetch_candidates(config, {})
+    return _candidates_from_rows(rows)
+
+def _candidates_from_rows(rows):
     for row in rows:
-        candidate_id = int(row['id'])
-        constituency_id = str(row['post_id'])
-
-        if row['email'] == '':
-            row['email'] = None
-        if row['twitter_username'] == '':
-            row['twitter_username'] = None
-
-        candidate = {
-            'id': candidate_id,
-            'name': row['name'],
-            'email': row['email'],
-            'twitter': row['twitter_username'],
-            'linkedin_url': row['linkedin_url'],
-            'party': row['party_name'],
-            'constituency_id': constituency_id,
-            'constituency_name': row['post_label']
-        }
-
-        # XXX reenable this when 546 candidate duplicate fixed
-        # assert candidate_id not in by_candidate_id, candidate_id
-        by_candidate_id[candidate_id] = candidate
-
-        by_constituency_id[constituency_id].append(candidate)
-
-    return by_candidate_id, by_constituency_id
+        yield candidatetable.Candidate(
+            int(row['id']),
+            row['name'],
+            row['email'] or None,
+            row['twitter_username'] or None,
+            row['linkedin_url'],
+            row['party_name'],
+            str(row['post_id']),
+            row['post_label']
+        )
 
 def candidates_csv_url():
     return "https://candidates.democracyclub.org.uk/media/candidates-" + elections.current_election + ".csv"
 
-def _fetch_candidates(config):
-    bucket = _get_s3_bucket(config)
-    key_name = "cache/candidates.csv"
+# Takes the validators from the last time we fetched, a dictionary of
+# the ETag and Last-Modified headers. Returns a pair of an iterator of the
+# CSV rows of candidates, or None if nothing has changed, and the new
+# validators. The rows are parsed as they are downloaded.
+def _fetch_candidates(config, validators):
+    store = _get_storage(config)
+    name = "cache/candidates.csv"
 
-    r = requests.get(candidates_csv_url())
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
 
-    if r.status_code == 200:
-        r.encoding = 'utf-8'
-        text = r.text
-        # save to bucket
-        key = boto.s3.key.Key(bucket)
-        key.key = key_name
-        key.set_contents_from_string(text)
+    try:
+        r = httpclient.get('candidates', candidates_csv_url(), headers=headers, stream=True)
+    except (httpclient.Unavailable, requests.RequestException) as e:
+        print("couldn't reach Candidates API:", e)
+        r = None
+
+    if r is not None and r.status_code == 304:
+        r.close()
+        return None, validators
+
+    if r is not None and r.status_code == 200:
+        # let urllib3 undo any gzip encoding for us
+        r.raw.decode_content = True
+        validators = {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified')
+        }
+        # save to storage, unless we already have this version
+        unknown_version = not validators['etag'] and not validators['last_modified']
+        if unknown_version or localdb.get_value(config, "candidates_csv_saved") != validators:
+            rows = _read_csv_saving_copy(config, r.raw, store, name, validators)
+        else:
+            rows = _read_csv(r.raw)
     else:
-        print("couldn't read from Candidates API; loading candidates from S3")
-        key = bucket.get_key(key_name)
-        text = key.get_contents_as_string().decode('utf-8')
-
-    return csv.DictReader(io.StringIO(text))
+        if r is not None:
+            r.close()
+        print("couldn't read from Candidates API; loading candidates from storage")
+        rows = _read_csv(store.open(name))
+        validators = {}
+
+    return rows, validators
+
+# File-like wrapper, which copies everything read through it into another
+# file. So we can parse the CSV as it downloads, and save it too.
+class _TeeReader(io.RawIOBase):
+    def __init__(self, source, copy=None):
+        self.source = source
+        self.copy = copy
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        if self.copy is not None:
+            self.copy.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+# Takes a file-like object of CSV bytes (e.g. a response or stored file),
+# returns an iterator of rows as it reads.
+def _read_csv(source, copy=None):
+    text = io.TextIOWrapper(io.BufferedReader(_TeeReader(source, copy)), encoding='utf-8', newline='')
+    return csv.DictReader(text)
+
+# Like _read_csv, but once all the rows have been read saves the raw file
+# to storage. Only the one copy is kept, on disk.
+def _read_csv_saving_copy(config, source, store, name, validators):
+    with tempfile.TemporaryFile() as copy:
+        yield from _read_csv(source, copy)
+        copy.seek(0)
+        store.write(name, copy, content_type="text/csv")
+    localdb.set_value(config, "candidates_csv_saved", validators)
 
 # Takes a constituency identifier and returns a dictionary:
 #   error - if there was an error
-# Or an array of dictionaries with fields as in _hashes_of_candidates.
+# Or an array of dictionaries with fields as in _candidate_table.
 def lookup_candidates(config, constituency_id):
     if constituency_id == "8888888":
         return [
-            { 'id': 7777777, 'name' : 'Sicnarf Gnivri', 'email': 'frabcus+sicnarf@fastmail.fm', 'twitter': 'frabcus+sicnarf', 'linkedin_url': 'https://www.linkedin.com/in/FrancisIrving', 'party': 'Bunny Rabbits Rule',
+            { 'id': 7777778, 'name' : 'Notlits Esuom', 'email': 'frabcus+notlits@fastmail.fm', 'twitter': 'frabcus+notlits', 'linkedin_url': 'https://www.linkedin.com/in/FrancisIrving', 'party': 'Mice Rule More',
                 'constituency_id': "8888888", 'constituency_name': "Democracy Club Test Constituency"
             },
-            { 'id': 7777778, 'name' : 'Notlits Esuom', 'email': 'frabcus+notlits@fastmail.fm', 'twitter': 'frabcus+notlits', 'linkedin_url': 'https://www.linkedin.com/in/FrancisIrving', 'party': 'Mice Rule More',
+            { 'id': 7777777, 'name' : 'Sicnarf Gnivri', 'email': 'frabcus+sicnarf@fastmail.fm', 'twitter': 'frabcus+sicnarf', 'linkedin_url': 'https://www.linkedin.com/in/FrancisIrving', 'party': 'Bunny Rabbits Rule',
                 'constituency_id': "8888888", 'constituency_name': "Democracy Club Test Constituency"
             },
             { 'id': 7777779, 'name' : 'Ojom Yeknom', 'email': 'frabcus+ojom@fastmail.fm', 'twitter': None, 'linkedin_url': None, 'party': 'Monkeys Are Best',
@@ -167,22 +334,17 @@ def lookup_candidates(config, constituency_id):
             }
         ]
 
-    _, by_constituency_id = _hashes_of_candidates(config)
+    # already in ballot paper order, see candidatetable.surname
+    current_candidate_list = _candidate_table(config).constituency(constituency_id)
 
-    if constituency_id not in by_constituency_id:
+    if current_candidate_list is None:
         return { 'error': "Constituency not found: {}".format(constituency_id)}
 
-    current_candidate_list = by_constituency_id[constituency_id]
-
-    # Sort by surname (as best we can -- "Duncan Smith" won't work)
-    # so it is same as on ballot paper. So can get used to it.
-    def surname(candidate):
-        return candidate['name'].split(" ")[-1]
-    return sorted(current_candidate_list, key=surname)
+    return current_candidate_list
 
 # Takes a candidate identifier (mySociety person_id) and returns a dictionary:
 #   error - if there's an error
-# Or fields as in _hashes_of_candidates.
+# Or fields as in _candidate_table.
 def lookup_candidate(config, person_id):
     if person_id == 7777777:
         return {
@@ -200,29 +362,28 @@ def lookup_candidate(config, person_id):
             'constituency_id': "8888888", 'constituency_name': "Democracy Club Test Constituency"
         }
 
-    by_candidate_id, _ = _hashes_of_candidates(config)
+    candidate = _candidate_table(config).candidate(person_id)
 
-    if person_id not in by_candidate_id:
+    if candidate is None:
         return { 'error': "Candidate not found: {}".format(person_id) }
 
-    candidate = by_candidate_id[person_id]
-
     return candidate
 
+# Returns how many candidates there are in total.
+def count_candidates(config):
+    return len(_candidate_table(config))
+
 
 # Returns an array of every constituency alphabetically by name.
 # Each constituency is an array of candidates, with fields
-# from _hashes_of_candidates and from augment_if_has_cv.
+# from _candidate_table and from augment_if_has_cv.
 def all_constituencies(config):
+    table = _candidate_table(config)
 
-    _, by_constituency_id = _hashes_of_candidates(config)
-
+    # already in order, see candidatetable.CandidateTable
     result = []
-    for constituency_id, candidates in by_constituency_id.items():
-        candidates = augment_if_has_cv(config, candidates)
-        result.append(candidates)
-
-    result = sorted(result, key=lambda x: x[0]['constituency_name'])
+    for constituency_id in table.constituency_ids():
+        result.append(augment_if_has_cv(config, table.constituency(constituency_id)))
 
     return result
 
@@ -230,34 +391,73 @@ def all_constituencies(config):
 # Storing CVs
 
 
-# Takes the app config (for S3 keys), candidate identifier, file contents, a
-# (secured) filename and content type. Saves that new CV in S3. Raises
-# an exception if it goes wrong, returns nothing.
+# Takes the app config (for storage settings), candidate identifier, file
+# contents (bytes, or a binary file object to stream from) and a (secured)
+# filename. Saves that new CV in storage. Raises an exception if it goes
+# wrong, returns nothing.
 def add_cv(config, person_id, contents, filename):
     person_id = str(int(person_id))
     assert person_id != 0
 
-    bucket = _get_s3_bucket(config)
-
     when = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S-")
-
-    key = boto.s3.key.Key(bucket)
-    key.key = "cvs/" + str(person_id) + "/" + when + filename
-    key.set_contents_from_string(contents)
-    key.set_acl('public-read')
-
-
-# Takes the app config (for S3 keys), candidate identifier, a local filename, a
-# filename in the bucket and the extension to use in mime type. Saves thumbnail
-# in S3. Raises an exception if it goes wrong, returns nothing.
-def add_thumb(config, local_filename, remote_filename, extension):
-    bucket = _get_s3_bucket(config)
-
-    key = boto.s3.key.Key(bucket)
-    key.key = remote_filename
-    key.set_contents_from_filename(local_filename)
-    key.set_metadata('Content-Type', "image/" + extension)
-    key.set_acl('public-read')
+    name = "cvs/" + str(person_id) + "/" + when + filename
+
+    store = _get_storage(config)
+    store.write(name, contents, public=True)
+
+    _add_to_key_index(config, "cvs/", name, store.url(name))
+    # made by the job queue's worker, see thumbnails._make_thumbnail_job
+    jobqueue.enqueue(config, "thumbnail", { 'person_id': int(person_id) })
+
+
+# Takes the app config, candidate identifier, a binary file object of an
+# upload and a (secured) filename. Quickly saves the upload to a local
+# file, and queues a job to save it as the candidate's new CV, see
+# jobqueue.py.
+def queue_cv_upload(config, person_id, upload, filename):
+    directory = config.get('UPLOAD_SPOOL_DIR', 'tmp/uploads')
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix="-" + filename)
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(upload, f)
+
+    jobqueue.enqueue(config, "add_cv", { 'person_id': int(person_id), 'filename': filename, 'path': path })
+
+@jobqueue.handler("add_cv")
+def _add_cv_job(config, payload):
+    # already done, by an earlier try which didn't finish
+    if not os.path.exists(payload['path']):
+        return
+    with open(payload['path'], 'rb') as f:
+        add_cv(config, payload['person_id'], f, payload['filename'])
+    os.remove(payload['path'])
+
+
+IMAGE_CONTENT_TYPES = { "jpg": "image/jpeg", "webp": "image/webp" }
+
+# Takes the app config (for storage settings), a local filename, a filename
+# in storage and the extension to use in mime type. Saves thumbnail in
+# storage. Optionally takes the candidate, as lookup_candidate, so it isn't
+# looked up again. Raises an exception if it goes wrong, returns nothing.
+def add_thumb(config, local_filename, remote_filename, extension, candidate=None):
+    store = _get_storage(config)
+    with open(local_filename, 'rb') as f:
+        store.write(remote_filename, f, content_type=IMAGE_CONTENT_TYPES[extension], public=True)
+
+    _add_to_key_index(config, "thumbs/", remote_filename, store.url(remote_filename), candidate)
+
+# Takes the app config, the name in storage of a main thumbnail, and a list
+# of (local filename, name in storage, format) of its other sizes and formats
+# (see thumbnail_variant_name), as thumbnails.make_variants returns. Saves
+# them all in storage, then records in the key index that the thumbnail has
+# them, under "thumb_variants/". Optionally takes the candidate, as add_thumb.
+def add_thumb_variants(config, thumb_name, variants, candidate=None):
+    store = _get_storage(config)
+    for local_filename, remote_filename, extension in variants:
+        with open(local_filename, 'rb') as f:
+            store.write(remote_filename, f, content_type=IMAGE_CONTENT_TYPES[extension], public=True)
+
+    _add_to_key_index(config, "thumbs/", thumb_name, store.url(thumb_name), candidate, index_prefix="thumb_variants/")
 
 
 # Takes a candidate id, and returns most recent CV. Fields of CV
@@ -280,41 +480,127 @@ def get_current_thumb(config, person_id):
 
     return thumb_hash[person_id]
 
+# As well as the main thumbnail, a 400 pixel wide JPEG, we make smaller
+# ones, and WebP versions, so browsers can download just what they need
+THUMBNAIL_WIDTHS = [100, 200, 400]
+THUMBNAIL_FORMATS = ["webp", "jpg"]
+
+# Name of the thumbnail for a CV, as made by cron.py
+def thumbnail_name(cv):
+    return cv['name'].replace("cvs/", "thumbs/") + ".jpg"
+
+# Takes the name (or URL) of a main thumbnail, and returns the name (or URL)
+# of its variant with a width and format.
+def thumbnail_variant_name(thumb_name, width, format):
+    if width == THUMBNAIL_WIDTHS[-1] and format == "jpg":
+        return thumb_name
+    return thumb_name[:-len(".jpg")] + ".{}.{}".format(width, format)
+
+# Takes a name in storage, and returns the name of the main thumbnail it
+# would be a variant of, or None if it can't be one.
+def _thumbnail_of_variant(name):
+    match = re.match(r"(.*)\.(" + "|".join(str(width) for width in THUMBNAIL_WIDTHS) + r")\.(" +
+        "|".join(THUMBNAIL_FORMATS) + r")$", name)
+    if match is None:
+        return None
+    return match.group(1) + ".jpg"
+
+# Takes a thumbnail, with fields as in _hash_by_prefix, and the hash of
+# those with variants (the "thumb_variants/" key index). Returns a copy with
+# a 'variants' field, a dictionary from format to a list of (width, URL) of
+# its variants. Or None if they haven't been made yet, e.g. for thumbnails
+# from before there were variants, until cron.py makes them.
+def _thumb_with_variants(thumb, variants_hash):
+    thumb = dict(thumb)
+    thumb['variants'] = None
+    if _has_variants(thumb, variants_hash):
+        thumb['variants'] = { format: [ (width, thumbnail_variant_name(thumb['url'], width, format))
+                for width in THUMBNAIL_WIDTHS ]
+            for format in THUMBNAIL_FORMATS }
+    return thumb
+
+def _has_variants(thumb, variants_hash):
+    variants = variants_hash.get(thumb['person_id'])
+    return variants is not None and variants['name'] == thumb['name']
+
+# Takes the app config (for storage), returns a list of all the up to date
+# thumbnails which don't have their variants yet, with fields as in
+# _hash_by_prefix.
+def all_thumbs_missing_variants(config):
+    cv_hash = _hash_by_prefix(config, "cvs/")
+    thumb_hash = _hash_by_prefix(config, "thumbs/")
+    variants_hash = keyindex.hash_by_prefix(config, "thumb_variants/")
+
+    return [ thumb for person_id, thumb in thumb_hash.items()
+        if person_id in cv_hash and thumbnail_name(cv_hash[person_id]) == thumb['name']
+            and not _has_variants(thumb, variants_hash) ]
+
+# Takes a candidate id, and returns their current CV (as get_current_cv) if
+# it needs a new thumbnail making, otherwise None.
+def cv_needing_thumbnail(config, person_id):
+    # no thumbnail for the test one
+    if person_id == 7777777:
+        return None
+    cv = get_current_cv(config, person_id)
+    if cv is None:
+        return None
+    thumb = get_current_thumb(config, person_id)
+    if thumb is not None and thumb['name'] == thumbnail_name(cv):
+        return None
+    return cv
+
 # Takes an array of candidates of the same form list_candidates returns.
-# Auguments with a variable to say if they have a CV, and when last updated.
+# Returns a copy of them as dictionaries, augmented with a variable to say
+# if they have a CV, and when last updated. Thumbnails have the 'variants'
+# field of _thumb_with_variants.
 def augment_if_has_cv(config, candidates):
     cv_hash = _hash_by_prefix(config, "cvs/")
     thumb_hash = _hash_by_prefix(config, "thumbs/")
+    variants_hash = keyindex.hash_by_prefix(config, "thumb_variants/")
 
+    augmented = []
     for candidate in candidates:
+        candidate = dict(candidate)
+        augmented.append(candidate)
 
         if candidate['id'] in cv_hash:
 
             candidate['has_cv'] = True
-            candidate['cv'] = cv_hash[candidate['id']]
+            candidate['cv'] = dict(cv_hash[candidate['id']])
 
             if candidate['id'] in thumb_hash:
                 candidate['cv']['has_thumb'] = True
-                candidate['cv']['thumb'] = thumb_hash[candidate['id']]
+                candidate['cv']['thumb'] = _thumb_with_variants(thumb_hash[candidate['id']], variants_hash)
             else:
                 candidate['cv']['has_thumb'] = False
         else:
             candidate['has_cv'] = False
 
-    return candidates
+    return augmented
 
 
-# Takes the app config (for S3), returns a list, ordered by reverse time,
+# Takes the app config (for storage), returns a list, ordered by reverse time,
 # of all CVs which have thumbnails from any candidate, with the following
 # fields:
 #   all the fields of _hash_by_prefix
 #   has_thumb - True
-#   thumb - dictionary of details, including all the fields of _hash_by_prefix
+#   thumb - dictionary of details, including all the fields of _hash_by_prefix,
+#           and variants, as _thumb_with_variants
 def all_cvs_with_thumbnails(config):
+    return list(_cvs_with_thumbnails(config))
+
+# Takes the app config (for storage), returns the thumbnail of the most recent
+# CV in all_cvs_with_thumbnails, or None if there isn't one.
+def most_recent_thumbnail(config):
+    for cv in _cvs_with_thumbnails(config):
+        return cv['thumb']
+    return None
+
+def _cvs_with_thumbnails(config):
     cv_hash = _hash_by_prefix(config, "cvs/")
     thumb_hash = _hash_by_prefix(config, "thumbs/")
+    variants_hash = keyindex.hash_by_prefix(config, "thumb_variants/")
 
-    cvs = []
     for person_id, cv in cv_hash.items():
         # strip out the test one
         if person_id == 7777777:
@@ -322,16 +608,16 @@ def all_cvs_with_thumbnails(config):
         if 'removed_after_election_by_candidate' in cv['url']:
             continue
         if cv['person_id'] in thumb_hash:
+            cv = dict(cv)
             cv['has_thumb'] = True
-            cv['thumb'] = thumb_hash[person_id]
-            cv['candidate'] = lookup_candidate(config, cv['person_id'])
+            cv['thumb'] = _thumb_with_variants(thumb_hash[person_id], variants_hash)
+            candidate = lookup_candidate(config, cv['person_id'])
             # can have CVs for people who aren't candidates (e.g. withdrew)
-            if 'error' not in cv['candidate']:
-                cvs.append(cv)
-
-    return cvs
+            if 'error' not in candidate:
+                cv['candidate'] = dict(candidate)
+                yield cv
 
-# Takes the app config (for S3), returns a list, ordered by reverse time,
+# Takes the app config (for storage), returns a list, ordered by reverse time,
 # of all CVs from any candidate which don't have an up to date thumbnails, with
 # the following fields:
 #   all the fields of _hash_by_prefix
@@ -345,61 +631,137 @@ def all_cvs_bad_thumbnails(config):
         # strip out the test one
         if person_id == 7777777:
             continue
-        # no thumb at all
-        if person_id not in thumb_hash:
+        # no thumb at all, or latest thumb doesn't match name of CV file using
+        if person_id not in thumb_hash or thumbnail_name(cv) != thumb_hash[person_id]['name']:
+            cv = dict(cv)
             cv['has_thumb'] = False
             cvs.append(cv)
-            continue
-        # latest thumb doesn't match name of CV file using
-        cv_name = cv['name']
-        thumb_name = thumb_hash[person_id]['name']
-        if cv_name.replace("cvs/", "thumbs/") + ".jpg" != thumb_name:
-            cv['has_thumb'] = False
-            cvs.append(cv)
-            continue
 
     return cvs
 
 
+# How long a worker has to reconcile the key index before another tries
+KEY_INDEX_RECONCILE_LEASE = 60 * 5
+
+# How often workers waiting for another to reconcile check if it has
+KEY_INDEX_WAIT_INTERVAL = 0.5
+
+# Takes an index module (keyindex or subscribers), the arguments which pick
+# out the index, and the function which reconciles it. For when the index
+# has never been reconciled, so we have to wait for it. Only one worker
+# lists storage, the rest wait for it to finish, and take over if it
+# fails or its lease runs out (e.g. it died).
+def _first_reconcile(index, args, reconcile):
+    while index.reconciled_age(*args) is None:
+        if index.claim_reconcile(*args, KEY_INDEX_RECONCILE_LEASE):
+            try:
+                reconcile(*args)
+            except Exception:
+                index.release_reconcile(*args)
+                raise
+            return
+        time.sleep(KEY_INDEX_WAIT_INTERVAL)
+
 # Given a prefix, returns a hash from integer person_id to
-# a dictionary with the following fields:
-#   name - full name of S3 key
+# a dictionary (shared, so copy it before changing it) with the following fields:
+#   name - full name of the key in storage
 #   url - publically accessible address of the file
 #   last_modified - when it was uploaded
 #   person_id - id of the person the CV is for
-# Caches for 10 minutes for speed.
-@app.cache.memoize(60 * 10)
+# Reads from the local key index, so never waits for S3 except the
+# very first time, when one worker lists it and the rest wait for that.
+# See reconcile_key_index.
 def _hash_by_prefix(config, prefix):
-    print("warming cache _hash_by_prefix", prefix)
-
-    bucket = _get_s3_bucket(config)
-
-    cvs = bucket.list(prefix)
-    cvs = reversed(sorted(cvs, key=lambda k: k.last_modified))
+    age = keyindex.reconciled_age(config, prefix)
+    if age is None:
+        _first_reconcile(keyindex, (config, prefix), reconcile_key_index)
+    elif age > int(config.get('KEY_INDEX_MAX_AGE', 60 * 60)):
+        # only one worker does it, in the background
+        if keyindex.claim_reconcile(config, prefix, KEY_INDEX_RECONCILE_LEASE):
+            threading.Thread(target=reconcile_key_index, args=(config, prefix), daemon=True).start()
+
+    return keyindex.hash_by_prefix(config, prefix)
+
+# Lists every key with the prefix in storage, and brings the local key
+# index up to date with it. Slow.
+def reconcile_key_index(config, prefix):
+    print("reconciling key index", prefix)
+    listing_started = time.time()
+
+    cvs = _get_storage(config).list(prefix)
+    cvs = list(reversed(sorted(cvs, key=lambda k: k.last_modified)))
+    names = set(key.name for key in cvs)
 
     # Optionally filter to show what the CVs used to look like on a certain day
-    #cvs = filter(lambda k: boto.utils.parse_ts(k.last_modified) <= datetime.datetime(2015, 5, 8), cvs) # XXX temp debug
+    #cvs = filter(lambda k: k.last_modified <= datetime.datetime(2015, 5, 8), cvs) # XXX temp debug
 
-    person_ids = []
     result = collections.OrderedDict()
+    variant_names = set()
     for key in cvs:
         # we use .jpg thumbnails now (and don't accept images as CVs)
         if key.name.endswith(".png"):
             continue
+        # only the main thumbnail is indexed, not its variants
+        if prefix == "thumbs/" and _thumbnail_of_variant(key.name) in names:
+            variant_names.add(key.name)
+            continue
 
-        key_last_modified = boto.utils.parse_ts(key.last_modified)
+        key_last_modified = key.last_modified
         person_id = int(re.match(prefix + "([0-9]+)[^0-9]", key.name).group(1))
         if person_id not in result:
             result[person_id] =  {
                 'name': key.name,
-                'url': key.generate_url(expires_in=0, query_auth=False),
+                'url': key.url,
                 'last_modified': key_last_modified,
                 'created': key_last_modified,
                 'person_id': person_id
             }
         result[person_id]['created'] = key_last_modified
 
-    return result
+    keyindex.replace(config, prefix, result, listing_started)
+
+    # which of the thumbnails have all their variants (see add_thumb_variants)
+    if prefix == "thumbs/":
+        def has_variants(thumb):
+            names = [ thumbnail_variant_name(thumb['name'], width, format)
+                for format in THUMBNAIL_FORMATS for width in THUMBNAIL_WIDTHS ]
+            return all(name in variant_names for name in names if name != thumb['name'])
+        variants = collections.OrderedDict((person_id, thumb) for person_id, thumb in result.items()
+            if has_variants(thumb))
+        keyindex.replace(config, "thumb_variants/", variants, listing_started)
+
+# Records a file we've just written to storage in the local key index, and
+# tells every worker that the person's constituency page needs updating.
+# Takes the person's candidate (as lookup_candidate), if the caller has it,
+# and the prefix in the index to record it under, if not its own.
+def _add_to_key_index(config, prefix, name, url, candidate=None, index_prefix=None):
+    person_id = int(re.match(prefix + "([0-9]+)[^0-9]", name).group(1))
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+
+    # created is only used if it is their first key
+    keyindex.add(config, index_prefix or prefix, {
+        'name': name,
+        'url': url,
+        'last_modified': now,
+        'created': now,
+        'person_id': person_id
+    })
+
+    if candidate is None:
+        candidate = lookup_candidate(config, person_id)
+    if 'error' not in candidate:
+        keyindex.bump(config, "constituency/" + candidate['constituency_id'])
+
+# Returns something which changes whenever any CV or thumbnail (or its
+# variants) is added.
+def cvs_version(config):
+    return (keyindex.version(config, "cvs/"), keyindex.version(config, "thumbs/"),
+        keyindex.version(config, "thumb_variants/"))
+
+# Returns something which changes whenever a candidate in the
+# constituency gets a new CV or thumbnail.
+def constituency_version(config, constituency_id):
+    return keyindex.version(config, "constituency/" + str(constituency_id))
 
 
 ###################################################################
@@ -429,61 +791,99 @@ def split_candidates_by_updates(config, all_candidates, since):
 # Volunteer mailing list
 
 # Subscribe to updates - we store the postcode in a file names
-# after the email address.
+# after the email address. Also used to record when we last sent
+# updates to them.
 def updates_join(config, email, postcode):
     email = email.lower().replace("/", "_")
-    bucket = _get_s3_bucket(config)
+    _get_storage(config).write("updates/" + str(email), postcode)
+    subscribers.add(config, email, postcode, datetime.datetime.utcnow().replace(microsecond=0))
 
-    key = boto.s3.key.Key(bucket)
-    key.key = "updates/" + str(email)
-    key.set_contents_from_string(postcode)
-
-    url = key.generate_url(expires_in=0, query_auth=False)
-
-# Is the email already getting updates?
+# Is the email already getting updates? Uses the local index of
+# subscribers, see subscribers.py.
 def updates_getting(config, email):
     email = email.lower().replace("/", "_")
-    bucket = _get_s3_bucket(config)
 
-    prefix = "updates/" + str(email)
-    results = bucket.list(prefix)
+    age = subscribers.reconciled_age(config)
+    if age is None:
+        _first_reconcile(subscribers, (config,), reconcile_subscribers)
+    elif age > int(config.get('KEY_INDEX_MAX_AGE', 60 * 60)):
+        # only one worker does it, in the background
+        if subscribers.claim_reconcile(config, KEY_INDEX_RECONCILE_LEASE):
+            threading.Thread(target=reconcile_subscribers, args=(config,), daemon=True).start()
 
-    for result in results:
-        if result.name == "updates/" + str(email):
-            return True
+    return subscribers.contains(config, email)
 
-    return False
+# Lists every subscription in storage, and brings the local index of
+# subscribers up to date with it. Slow.
+def reconcile_subscribers(config):
+    print("reconciling subscribers")
+    listing_started = time.time()
 
-# Used for sending the mailings out, slow. Last modified of
-# the subscription S3 file is the last sent to date.
-def slow_updates_list(config):
-    bucket = _get_s3_bucket(config)
+    entries = {}
+    for key in _get_storage(config).list("updates/"):
+        email = re.match("updates/(.*)", key.name).group(1)
+        entries[email] = key.last_modified
 
-    prefix = "updates/"
-    results = bucket.list(prefix)
-    results = sorted(results, key=lambda k: k.last_modified)
+    subscribers.replace(config, entries, listing_started)
 
-    for key in results:
-        email = re.match("updates/(.*)", key.name).group(1)
-        postcode = key.get_contents_as_string().strip().decode('ascii')
-        constituency = lookup_postcode(postcode)
+# Threads used to read subscriptions and look up their postcodes in
+# updates_list, as each is a separate request
+UPDATES_LIST_THREADS = 16
+
+# Used for sending the mailings out. Returns a list, oldest sent to first,
+# of every subscriber as a dictionary with their email, postcode,
+# constituency, candidates (as augment_if_has_cv) and counts and lists
+# of those from split_candidates_by_type and split_candidates_by_updates.
+# The last modified of the subscription file is the last sent to date.
+#
+# Subscribers come from the local index, brought up to date first. Any
+# postcodes it doesn't know are read from storage several at once, and the
+# candidates in each constituency are worked out just once, and shared by
+# everyone subscribed there.
+def updates_list(config):
+    reconcile_subscribers(config)
+    subscriber_list = subscribers.all_subscribers(config)
+
+    def read_postcode(email):
+        return _get_storage(config).read("updates/" + email).strip().decode('ascii')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPDATES_LIST_THREADS) as pool:
+        unknown = [ subscriber['email'] for subscriber in subscriber_list if subscriber['postcode'] is None ]
+        postcodes = dict(zip(unknown, pool.map(read_postcode, unknown)))
+        subscribers.set_postcodes(config, postcodes)
+        for subscriber in subscriber_list:
+            if subscriber['postcode'] is None:
+                subscriber['postcode'] = postcodes[subscriber['email']]
+
+        # lots of people share a postcode
+        canon_postcodes = list(set(subscriber['postcode'].upper().replace(" ", "") for subscriber in subscriber_list))
+        constituencies = dict(zip(canon_postcodes, pool.map(lookup_postcode, canon_postcodes)))
+
+    by_constituency = {}
+    results = []
+    for subscriber in subscriber_list:
+        constituency = constituencies[subscriber['postcode'].upper().replace(" ", "")]
         if 'error' in constituency:
-            print("ERROR looking up postcode", postcode)
+            print("ERROR looking up postcode", subscriber['postcode'])
             continue
-        last_modified = boto.utils.parse_ts(key.last_modified)
 
-        candidates = lookup_candidates(config, constituency['id'])
-        if 'errors' in candidates:
-            print("ERROR looking up candidates", postcode)
+        if constituency['id'] not in by_constituency:
+            candidates = lookup_candidates(config, constituency['id'])
+            if 'error' in candidates:
+                by_constituency[constituency['id']] = None
+            else:
+                candidates = augment_if_has_cv(config, candidates)
+                by_constituency[constituency['id']] = (candidates, split_candidates_by_type(config, candidates))
+        if by_constituency[constituency['id']] is None:
+            print("ERROR looking up candidates", subscriber['postcode'])
             continue
 
-        candidates = augment_if_has_cv(config, candidates)
-        candidates_no_cv, candidates_no_email, candidates_have_cv = split_candidates_by_type(config, candidates)
-        candidates_cv_created, candidates_cv_updated = split_candidates_by_updates(config, candidates, last_modified)
+        candidates, (candidates_no_cv, candidates_no_email, candidates_have_cv) = by_constituency[constituency['id']]
+        candidates_cv_created, candidates_cv_updated = split_candidates_by_updates(config, candidates, subscriber['last_modified'])
 
-        subscriber = {
-            'email': email,
-            'postcode': postcode,
+        results.append({
+            'email': subscriber['email'],
+            'postcode': subscriber['postcode'],
             'constituency': constituency,
 
             'candidates': candidates,
@@ -494,38 +894,94 @@ def slow_updates_list(config):
 
             'candidates_cv_created': candidates_cv_created,
             'candidates_cv_updated': candidates_cv_updated,
-            'last_modified': last_modified
-        }
+            'last_modified': subscriber['last_modified']
+        })
 
-
-        yield subscriber
+    return results
 
 
 ###################################################################
 # Last mailed a candidate
 
-def candidate_mail_sent(config, email):
-    email = email.lower().replace("/", "_")
-    bucket = _get_s3_bucket(config)
-
-    key = boto.s3.key.Key(bucket)
-    key.key = "candidate_mail/" + str(email)
-    key.set_contents_from_string("sent")
-
-    url = key.generate_url(expires_in=0, query_auth=False)
-
-def candidate_mail_last_sent(config):
-    bucket = _get_s3_bucket(config)
-
-    prefix = "candidate_mail/"
-    results = bucket.list(prefix)
-    results = sorted(results, key=lambda k: k.last_modified)
-
-    ret = {}
-    for key in results:
-        email = re.match("candidate_mail/(.*)", key.name).group(1)
-        last_modified = boto.utils.parse_ts(key.last_modified)
-        ret[email] = last_modified
-
-    return ret
-
+# Records that we've asked a candidate if we can use their LinkedIn
+# profile as their CV (see bin/mail-linkedin.py), in storage and in the
+# key index, so it is seen straight away.
+def linkedin_mail_sent(config, person_id):
+    name = "mailed/linkedin/" + str(person_id) + ".sent"
+    store = _get_storage(config)
+    store.write(name, "sent")
+    _add_to_key_index(config, "mailed/linkedin/", name, store.url(name))
+
+# Returns a hash from person_id, as _hash_by_prefix, of the candidates we've
+# asked about LinkedIn. Lists storage first, to include any mailed from
+# another machine.
+def linkedin_mailed(config):
+    reconcile_key_index(config, "mailed/linkedin/")
+    return _hash_by_prefix(config, "mailed/linkedin/")
+
+# Records that we've just emailed a list of candidates. Each batch is saved
+# as one file in storage, listing their emails, and added to the local log
+# in candidatemail.py.
+def candidate_mail_sent(config, emails):
+    emails = [ email.lower() for email in emails ]
+    now = datetime.datetime.utcnow()
+    _get_storage(config).write("candidate_mail/batches/" + now.isoformat() + ".txt", "\n".join(emails))
+    candidatemail.add(config, emails, now)
+
+# Returns the set of candidate emails (in lower case) we've mailed at or
+# after a time (naive UTC datetime). Includes any batches saved in storage
+# since we last looked, e.g. from another machine.
+def candidates_mailed_since(config, since):
+    imported_at = localdb.get_value(config, "candidate_mail_imported_at")
+    if imported_at is None:
+        import_candidate_mail(config)
+    else:
+        _import_new_candidate_mail(config, datetime.datetime.fromisoformat(imported_at))
+    return candidatemail.mailed_since(config, since)
+
+# Takes a batch saved by candidate_mail_sent, and returns the emails in it
+# and when they were sent, from its name.
+def _read_candidate_mail_batch(store, key):
+    sent_at = datetime.datetime.fromisoformat(re.match("candidate_mail/batches/(.*)\\.txt$", key.name).group(1))
+    return store.read(key.name).decode('utf-8').split(), sent_at
+
+# Builds the local log of candidate mail from storage. As well as the
+# batches from candidate_mail_sent, there are files from before those, one
+# per candidate named after their email, last modified when we mailed them.
+# Slow.
+def import_candidate_mail(config):
+    print("importing candidate mail log")
+    store = _get_storage(config)
+    listing_started = datetime.datetime.utcnow()
+
+    entries = []
+    for key in store.list("candidate_mail/"):
+        if key.name.startswith("candidate_mail/batches/"):
+            emails, sent_at = _read_candidate_mail_batch(store, key)
+            entries.extend((email, sent_at) for email in emails)
+        else:
+            email = re.match("candidate_mail/(.*)", key.name).group(1)
+            entries.append((email, key.last_modified))
+
+    candidatemail.replace(config, entries)
+    localdb.set_value(config, "candidate_mail_imported_at", listing_started.isoformat())
+
+# Batches saved up to this long before we last listed them are read again,
+# in case the storage server's clock is behind ours, or a batch didn't make
+# it into the listing
+CANDIDATE_MAIL_IMPORT_MARGIN = datetime.timedelta(hours=1)
+
+# Adds to the local log any batches saved in storage since a time, when we
+# last listed them. Only lists the batches, so quicker than
+# import_candidate_mail.
+def _import_new_candidate_mail(config, imported_at):
+    store = _get_storage(config)
+    listing_started = datetime.datetime.utcnow()
+
+    for key in store.list("candidate_mail/batches/"):
+        if key.last_modified >= imported_at - CANDIDATE_MAIL_IMPORT_MARGIN:
+            emails, sent_at = _read_candidate_mail_batch(store, key)
+            # including ones we saved ourselves, which add ignores
+            candidatemail.add(config, emails, sent_at)
+
+    localdb.set_value(config, "candidate_mail_imported_at", listing_started.isoformat())
@@ -6,6 +6,19 @@ import os
 import unittest
 import coverage
 import re
+import tempfile
+import datetime
+import time
+import pickle
+import smtplib
+import io
+import urllib.parse
+import http.server
+import threading
+import json
+
+import PIL.Image
+import flask_mail
 
 cov = coverage.coverage(branch = True, omit=["^/*", "main_tests.py"], include=["[a-z_]*.py"])
 cov.start()
@@ -13,8 +26,47 @@ cov.start()
 os.environ['MPCV_SECRET_KEY'] = 'doesnotmatterastesting'
 os.environ['MPCV_DEBUG_EMAIL'] = 'test@localhost'
 os.environ['MPCV_TESTING'] = 'True'
+# without S3 settings, run entirely locally
+if 'MPCV_S3_BUCKET_NAME' not in os.environ:
+    os.environ['MPCV_STORAGE_BACKEND'] = 'local'
+    os.environ['MPCV_STORAGE_DIR'] = tempfile.mkdtemp()
 
 import app
+import lookups
+import identity
+import keyindex
+import localdb
+import candidatemail
+import subscribers
+import candidatetable
+import refresh
+import postcodetable
+import httpclient
+import bulkmail
+import jobqueue
+import storage
+import outbox
+import thumbnails
+
+# Local storage starts empty, so add what the tests expect to be in S3: a
+# CV for the test candidate, and a CV and thumbnail for a real candidate.
+def fill_local_storage(config):
+    with open('fixtures/Example MP candidate CV.doc', 'rb') as f:
+        contents = f.read()
+    lookups.add_cv(config, 7777777, contents, 'Example_MP_candidate_CV.doc')
+
+    candidate = next(lookups.stream_candidates(config))
+    lookups.add_cv(config, candidate['id'], contents, 'Example_MP_candidate_CV.doc')
+    cv = lookups.get_current_cv(config, candidate['id'])
+    directory = tempfile.mkdtemp()
+    thumb_filename = os.path.join(directory, 'thumb.jpg')
+    PIL.Image.open('static/blank-cv.png').convert("RGB").save(thumb_filename)
+    thumb_name = lookups.thumbnail_name(cv)
+    lookups.add_thumb_variants(config, thumb_name, thumbnails.make_variants(thumb_filename, thumb_name, directory))
+    lookups.add_thumb(config, thumb_filename, thumb_name, extension="jpg")
+
+if app.app.config.get('STORAGE_BACKEND') == 'local':
+    fill_local_storage(app.app.config)
 
 class MainTestCase(unittest.TestCase):
 
@@ -127,6 +179,27 @@ class MainTestCase(unittest.TestCase):
         self.assertIn('Your CV has been successfully uploaded', rup.get_data(True))
         self.assertNotIn('alert-danger', rup.get_data(True))
 
+        # CV is straight away the current one, without waiting for S3
+        current_cv = lookups.get_current_cv(app.app.config, 7777777)
+        self.assertTrue(current_cv['name'].endswith('Example_MP_candidate_CV.doc'))
+        if app.app.config.get('STORAGE_BACKEND') == 'local':
+            r = self.app.get(urllib.parse.urlparse(current_cv['url']).path)
+            self.assertEqual(r.status_code, 200)
+            r.close()
+
+    def test_upload_cv_too_big(self):
+        person_id = 7777777
+        confirmation_url = '/upload_cv/{}/c/{}'.format(person_id, identity.sign_person_id(app.app.secret_key, person_id))
+        max_content_length = app.app.config['MAX_CONTENT_LENGTH']
+        app.app.config['MAX_CONTENT_LENGTH'] = 1000
+        try:
+            r = self.app.post(confirmation_url, data=dict(
+               files=(io.BytesIO(b"x" * 2000), 'big.pdf'),
+             ), follow_redirects=True)
+        finally:
+            app.app.config['MAX_CONTENT_LENGTH'] = max_content_length
+        self.assertIn('That file is too big', r.get_data(True))
+
     def test_badly_signed_confirmation_link(self):
         r = self.app.get('/upload_cv/7777777/c/xxxxxyyyyyy', follow_redirects=True)
         self.assertEqual(r.status_code, 500)
@@ -146,6 +219,32 @@ class MainTestCase(unittest.TestCase):
         r = self.app.get('/browse/party/small')
         self.assertEqual(r.status_code, 200)
         self.assertIn('Browse', r.get_data(True))
+        if app.app.config.get('STORAGE_BACKEND') == 'local':
+            self.assertIn('.100.webp 100w', r.get_data(True))
+
+    def test_thumb_variants(self):
+        if app.app.config.get('STORAGE_BACKEND') != 'local':
+            return
+        config = app.app.config
+        candidate = next(lookups.stream_candidates(config))
+        thumb = lookups.get_current_thumb(config, candidate['id'])
+        def variants():
+            cvs = lookups.all_cvs_with_thumbnails(config)
+            return [ cv['thumb']['variants'] for cv in cvs if cv['person_id'] == candidate['id'] ][0]
+        self.assertIsNotNone(variants())
+
+        # as if the thumbnail was made before there were variants
+        keyindex.replace(config, "thumb_variants/", {}, time.time())
+        self.assertIsNone(variants())
+        self.assertIn(thumb, lookups.all_thumbs_missing_variants(config))
+        # which doesn't mean the CV needs rendering again
+        self.assertNotIn(candidate['id'], [ cv['person_id'] for cv in lookups.all_cvs_bad_thumbnails(config) ])
+
+        self.assertIsNone(thumbnails.make_missing_variants(config, thumb))
+        self.assertEqual(lookups.all_thumbs_missing_variants(config), [])
+        # and a full listing finds them too
+        lookups.reconcile_key_index(config, "thumbs/")
+        self.assertIsNotNone(variants())
 
     def test_browse_constituency(self):
         r = self.app.get('/browse/constituency/medium')
@@ -233,6 +332,544 @@ class MainTestCase(unittest.TestCase):
         }, follow_redirects=True)
 
         self.assertIn('Thanks for subscribing to updates!', r.get_data(True))
+        self.assertTrue(lookups.updates_getting(app.app.config, 'Frabcus+Voter@fastmail.fm'))
+        self.assertFalse(lookups.updates_getting(app.app.config, 'frabcus+nobody@fastmail.fm'))
+
+        # the real list is too big to get in a test
+        if app.app.config.get('STORAGE_BACKEND') == 'local':
+            subscriber = [ s for s in lookups.updates_list(app.app.config) if s['email'] == 'frabcus+voter@fastmail.fm' ][0]
+            self.assertEqual(subscriber['constituency']['id'], "8888888")
+            self.assertEqual(subscriber['has_cv_count'] + subscriber['no_cv_count'] + subscriber['no_email_count'], 3)
+
+
+    def test_linkedin_mailed(self):
+        lookups.linkedin_mailed(app.app.config)
+        lookups.linkedin_mail_sent(app.app.config, 7777778)
+        # seen straight away, without waiting for the index to be reconciled
+        self.assertIn(7777778, lookups._hash_by_prefix(app.app.config, "mailed/linkedin/"))
+        self.assertIn(7777778, lookups.linkedin_mailed(app.app.config))
+
+class KeyIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite') }
+
+    def entry(self, person_id, name, day):
+        when = datetime.datetime(2019, 11, day)
+        return { 'person_id': person_id, 'name': name, 'url': 'https://example.com/' + name,
+            'last_modified': when, 'created': when }
+
+    def test_add_and_replace(self):
+        self.assertIsNone(keyindex.reconciled_age(self.config, "cvs/"))
+        keyindex.replace(self.config, "cvs/", { 1: self.entry(1, "cvs/1/a.pdf", 1) }, 0)
+        self.assertIsNotNone(keyindex.reconciled_age(self.config, "cvs/"))
+        version = keyindex.version(self.config, "cvs/")
+
+        # newer upload for same person replaces name but keeps created
+        keyindex.add(self.config, "cvs/", self.entry(1, "cvs/1/b.pdf", 3))
+        keyindex.add(self.config, "cvs/", self.entry(2, "cvs/2/c.pdf", 2))
+        self.assertNotEqual(keyindex.version(self.config, "cvs/"), version)
+        cvs = keyindex.hash_by_prefix(self.config, "cvs/")
+        self.assertEqual(list(cvs.keys()), [1, 2])
+        self.assertEqual(cvs[1]['name'], "cvs/1/b.pdf")
+        self.assertEqual(cvs[1]['created'], datetime.datetime(2019, 11, 1))
+
+        # a listing which started before the uploads doesn't lose them
+        keyindex.replace(self.config, "cvs/", {}, 0)
+        self.assertEqual(len(keyindex.hash_by_prefix(self.config, "cvs/")), 2)
+
+        self.assertTrue(keyindex.claim_reconcile(self.config, "cvs/", 60))
+        self.assertFalse(keyindex.claim_reconcile(self.config, "cvs/", 60))
+
+    def test_first_reconcile_waits(self):
+        config = dict(self.config, STORAGE_BACKEND='local', STORAGE_DIR=os.path.join(tempfile.mkdtemp(), 'storage'))
+        # another worker is listing storage for the first time
+        self.assertTrue(keyindex.claim_reconcile(config, "cvs/", 60))
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(lookups._hash_by_prefix(config, "cvs/")))
+        thread.start()
+        time.sleep(lookups.KEY_INDEX_WAIT_INTERVAL * 2)
+        self.assertEqual(results, [])
+
+        # we get what it found, rather than listing again ourselves
+        keyindex.replace(config, "cvs/", { 1: self.entry(1, "cvs/1/a.pdf", 1) }, time.time())
+        thread.join()
+        self.assertEqual(list(results[0].keys()), [1])
+
+    def test_reconcile_thumb_variants(self):
+        config = dict(self.config, STORAGE_BACKEND='local', STORAGE_DIR=os.path.join(tempfile.mkdtemp(), 'storage'))
+        store = storage.get(config)
+        # a CV with no extension, whose name ends like a variant's
+        store.write("thumbs/1/2019-11-01T00:00:00-CV.2017.jpg", b"jpeg")
+        store.write("thumbs/2/2019-11-01T00:00:00-cv.pdf.jpg", b"jpeg")
+        for width in lookups.THUMBNAIL_WIDTHS:
+            for format in lookups.THUMBNAIL_FORMATS:
+                name = lookups.thumbnail_variant_name("thumbs/2/2019-11-01T00:00:00-cv.pdf.jpg", width, format)
+                store.write(name, b"image")
+
+        lookups.reconcile_key_index(config, "thumbs/")
+        thumbs = keyindex.hash_by_prefix(config, "thumbs/")
+        self.assertEqual(thumbs[1]['name'], "thumbs/1/2019-11-01T00:00:00-CV.2017.jpg")
+        self.assertEqual(thumbs[2]['name'], "thumbs/2/2019-11-01T00:00:00-cv.pdf.jpg")
+        self.assertEqual(list(keyindex.hash_by_prefix(config, "thumb_variants/")), [2])
+
+
+class SubscribersTestCase(unittest.TestCase):
+
+    def test_replace(self):
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite') }
+        joined = datetime.datetime(2019, 11, 1)
+        subscribers.add(config, "voter@example.com", "SW1A 1AA", joined)
+
+        # unchanged, so we still know the postcode
+        subscribers.replace(config, { "voter@example.com": joined }, time.time())
+        self.assertEqual([ s['postcode'] for s in subscribers.all_subscribers(config) ], ["SW1A 1AA"])
+
+        # joined again elsewhere, maybe with a new postcode, so it is read again
+        subscribers.replace(config, { "voter@example.com": datetime.datetime(2019, 11, 2) }, time.time())
+        self.assertEqual([ s['postcode'] for s in subscribers.all_subscribers(config) ], [None])
+
+
+class CandidateTableTestCase(unittest.TestCase):
+
+    def test_table(self):
+        table = candidatetable.CandidateTable([
+            candidatetable.Candidate(3, 'Eve Eff', None, 'eve', '', 'Red', 'E1', 'Aton'),
+            candidatetable.Candidate(2, 'Cat Dee', 'cat@localhost', None, '', 'Blue', 'E2', 'Beeton'),
+            candidatetable.Candidate(1, 'Ann Bee', None, None, '', 'Red', 'E1', 'Aton'),
+        ])
+        self.assertEqual(len(table), 3)
+        # constituencies by name, and candidates by surname
+        self.assertEqual(list(table.constituency_ids()), ['E1', 'E2'])
+        self.assertEqual([c['id'] for c in table.constituency('E1')], [1, 3])
+        self.assertIsNone(table.constituency('E3'))
+        self.assertIsNone(table.candidate(4))
+
+        candidate = table.candidate(2)
+        self.assertEqual(candidate['email'], 'cat@localhost')
+        self.assertNotIn('error', candidate)
+        self.assertEqual(dict(candidate)['constituency_name'], 'Beeton')
+        with self.assertRaises(AttributeError):
+            candidate.name = 'Changed'
+
+        # goes in the cache, so must pickle
+        table = pickle.loads(pickle.dumps(table))
+        self.assertEqual(table.candidate(3)['twitter'], 'eve')
+
+
+class CandidatesFetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.config = { 'LOCAL_DB_PATH': os.path.join(directory, 'test.sqlite'),
+            'STORAGE_BACKEND': 'local', 'STORAGE_DIR': os.path.join(directory, 'storage') }
+
+        # a Candidates API which supports conditional GET
+        responses = self.responses = []
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == '"v1"':
+                    body = b""
+                    self.send_response(304)
+                else:
+                    body = (b"id,name,email,twitter_username,linkedin_url,party_name,post_id,post_label\r\n"
+                        b"1,Alice,alice@example.com,,,Party,gss:E1,Somewhere\r\n")
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', '"v1"')
+                # before replying, as the client can be done straight after
+                responses.append((self.headers.get('If-None-Match'), body))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.HTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.old_url = lookups.candidates_csv_url
+        lookups.candidates_csv_url = lambda: "http://localhost:{}/candidates.csv".format(self.server.server_port)
+
+    def tearDown(self):
+        lookups.candidates_csv_url = self.old_url
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_changed(self):
+        rows, validators = lookups._fetch_candidates(self.config, { 'etag': '"v0"' })
+        self.assertEqual([ row['name'] for row in rows ], ['Alice'])
+        self.assertEqual(validators['etag'], '"v1"')
+        self.assertEqual(self.responses[0][0], '"v0"')
+
+    def test_not_changed(self):
+        rows, validators = lookups._fetch_candidates(self.config, { 'etag': '"v1"' })
+        self.assertIsNone(rows)
+        self.assertEqual(validators['etag'], '"v1"')
+        self.assertEqual(self.responses, [('"v1"', b"")])
+
+
+class S3StorageTestCase(unittest.TestCase):
+
+    def test_part_retried(self):
+        parts = []
+        failed = []
+
+        # fails the first time it is sent part 2, having read some of it
+        class Upload:
+            key_name = "cvs/1/big.pdf"
+            def upload_part_from_file(self, f, part_number, size):
+                data = f.read(size)
+                if part_number == 2 and not failed:
+                    failed.append(part_number)
+                    raise ConnectionError("dropped")
+                parts.append((part_number, data))
+
+        s3 = storage.S3Storage.__new__(storage.S3Storage)
+        contents = io.BytesIO(b"aaaabbbbcc")
+        for part_number, size in [(1, 4), (2, 4), (3, 2)]:
+            s3._upload_part(Upload(), contents, part_number, size)
+        self.assertEqual(parts, [(1, b"aaaa"), (2, b"bbbb"), (3, b"cc")])
+
+
+class PostcodeCacheTestCase(unittest.TestCase):
+
+    def test_ttl(self):
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite'),
+            'POSTCODE_CACHE_TTL': 1, 'POSTCODE_CACHE_INVALID_TTL': 60 }
+        calls = []
+
+        def fetch(canon_postcode):
+            calls.append(canon_postcode)
+            if canon_postcode.startswith("BAD"):
+                return { "error": "Postcode is not valid." }, 'POSTCODE_CACHE_INVALID_TTL'
+            return { 'id': "1", 'name': "Somewhere", 'postcode': canon_postcode }, 'POSTCODE_CACHE_TTL'
+
+        # unique, as the cache in memory is shared with other tests
+        good = "GOOD" + str(time.time())
+        bad = "BAD" + str(time.time())
+
+        # not fetched again within the TTL
+        self.assertEqual(lookups._remembered_lookup(config, good, fetch)['name'], "Somewhere")
+        self.assertEqual(lookups._remembered_lookup(config, good, fetch)['name'], "Somewhere")
+        self.assertEqual(calls, [good])
+
+        # invalid postcodes are remembered as invalid
+        self.assertEqual(lookups._remembered_lookup(config, bad, fetch)['error'], "Postcode is not valid.")
+        self.assertEqual(lookups._remembered_lookup(config, bad, fetch)['error'], "Postcode is not valid.")
+        self.assertEqual(calls, [good, bad])
+
+        # fetched again once the TTL runs out, but the invalid one has longer
+        time.sleep(1.1)
+        lookups._remembered_lookup(config, good, fetch)
+        lookups._remembered_lookup(config, bad, fetch)
+        self.assertEqual(calls, [good, bad, good])
+
+
+class PostcodeTableTestCase(unittest.TestCase):
+
+    def test_lookup(self):
+        path = os.path.join(tempfile.mkdtemp(), 'postcodes.table')
+        config = { 'POSTCODE_TABLE_PATH': path }
+        self.assertIsNone(postcodetable.lookup(config, 'SW1A 1AA'))
+
+        count = postcodetable.write(path, [
+            ('SW1A 1AA', 'gss:E14000639', 'Cities of London and Westminster'),
+            ('NE1 4ST', 'gss:E14000831', 'Newcastle upon Tyne Central'),
+            ('SW1A 2AA', 'gss:E14000639', 'Cities of London and Westminster'),
+        ])
+        self.assertEqual(count, 3)
+        self.assertEqual(postcodetable.lookup(config, 'sw1a2aa'), ('gss:E14000639', 'Cities of London and Westminster'))
+        self.assertEqual(postcodetable.lookup(config, 'NE1 4ST'), ('gss:E14000831', 'Newcastle upon Tyne Central'))
+        self.assertIsNone(postcodetable.lookup(config, 'SW1A 1AB'))
+
+
+class CandidateMailTestCase(unittest.TestCase):
+
+    def test_mailed_since(self):
+        directory = tempfile.mkdtemp()
+        config = { 'LOCAL_DB_PATH': os.path.join(directory, 'test.sqlite'),
+            'STORAGE_BACKEND': 'local', 'STORAGE_DIR': os.path.join(directory, 'storage') }
+        # from before there was a log
+        storage.get(config).write("candidate_mail/old@example.com", "sent")
+        lookups.candidate_mail_sent(config, ["New@Example.com", "other@example.com"])
+
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        tomorrow = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        mailed = { "old@example.com", "new@example.com", "other@example.com" }
+        self.assertEqual(lookups.candidates_mailed_since(config, yesterday), mailed)
+        self.assertEqual(lookups.candidates_mailed_since(config, tomorrow), set())
+
+        # the log can be rebuilt from storage
+        lookups.import_candidate_mail(config)
+        self.assertEqual(lookups.candidates_mailed_since(config, yesterday), mailed)
+
+        # batches saved since, e.g. by another machine, are picked up
+        now = datetime.datetime.utcnow()
+        storage.get(config).write("candidate_mail/batches/" + now.isoformat() + ".txt", "third@example.com")
+        self.assertEqual(lookups.candidates_mailed_since(config, yesterday), mailed | { "third@example.com" })
+        # without recording them twice
+        lookups.candidate_mail_sent(config, ["fourth@example.com"])
+        self.assertEqual(lookups.candidates_mailed_since(config, now), { "third@example.com", "fourth@example.com" })
+        rows = localdb.connect(config, candidatemail.SCHEMA).execute("SELECT COUNT(*) FROM candidate_mail").fetchone()
+        self.assertEqual(rows[0], 5)
+
+        # one stamped by a server whose clock is a bit behind ours
+        name = "candidate_mail/batches/" + datetime.datetime.utcnow().isoformat() + ".txt"
+        storage.get(config).write(name, "fifth@example.com")
+        path = os.path.join(config['STORAGE_DIR'], "private", *name.split("/"))
+        os.utime(path, (time.time() - 60, time.time() - 60))
+        self.assertIn("fifth@example.com", lookups.candidates_mailed_since(config, yesterday))
+
+
+class HttpClientTestCase(unittest.TestCase):
+
+    def test_circuit_breaker(self):
+        for i in range(httpclient.BREAKER_FAILURES):
+            httpclient._record('elections', False)
+        with self.assertRaises(httpclient.Unavailable):
+            httpclient.get('elections', "https://elections.democracyclub.org.uk/api/elections/")
+        # fails fast with a friendly message
+        self.assertIn('error', lookups._lookup_postcode_remote('SW1A1AA')[0])
+
+        httpclient._record('elections', True)
+        self.assertIs(httpclient.session(), httpclient.session())
+
+    def test_not_json(self):
+        # e.g. a 404 page
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = b"<html>Not found</html>"
+                self.send_response(404)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        old_url = lookups.ELECTIONS_API_URL
+        lookups.ELECTIONS_API_URL = "http://localhost:{}/api/elections/".format(server.server_port)
+        try:
+            self.assertEqual(lookups._lookup_postcode_remote('SW1A1AA'), ({ "error": "Postcode is not valid." }, None))
+        finally:
+            lookups.ELECTIONS_API_URL = old_url
+            server.shutdown()
+            server.server_close()
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def test_run_and_retry(self):
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite') }
+        done = []
+
+        @jobqueue.handler("test_job")
+        def test_job(config, payload):
+            if payload == "fail":
+                raise Exception("Failed as asked")
+            done.append(payload)
+
+        jobqueue.enqueue(config, "test_job", "hello")
+        jobqueue.enqueue(config, "test_job", "fail")
+        self.assertEqual(done, [])
+        self.assertEqual(jobqueue.run_pending(config), 2)
+        self.assertEqual(done, ["hello"])
+        # the failed one is tried again later, not straight away
+        self.assertEqual(jobqueue.run_pending(config), 0)
+
+    def test_never_eager(self):
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite'), 'TESTING': True }
+        done = []
+
+        @jobqueue.handler("slow_test_job", eager=False)
+        def slow_test_job(config, payload):
+            done.append(payload)
+
+        jobqueue.enqueue(config, "slow_test_job", "hello")
+        self.assertEqual(done, [])
+        self.assertEqual(jobqueue.run_pending(config), 1)
+        self.assertEqual(done, ["hello"])
+
+    def test_outbox(self):
+        # not TESTING, so it waits in the queue
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite') }
+        connections = []
+        connect = app.mail.connect
+        app.mail.connect = lambda: connections.append(True) or connect()
+        try:
+            with app.mail.record_messages() as sent:
+                with app.app.app_context():
+                    msg = flask_mail.Message(subject="Hello", body="Hi there", html="<p>Hi there</p>",
+                        sender=("Democracy Club CV", "cv@democracyclub.org.uk"), recipients=[('Sicnarf Gnivri', 'test@localhost')],
+                        cc=['cc@localhost'], reply_to="reply@localhost", extra_headers={ 'X-Test': 'yes' })
+                    msg.attach("cv.txt", "text/plain", b"My CV")
+                    outbox.send(config, msg)
+                    outbox.send(config, flask_mail.Message(subject="Again", body="Hi again",
+                        sender="cv@democracyclub.org.uk", recipients=['test@localhost']))
+                self.assertEqual(len(sent), 0)
+                self.assertEqual(jobqueue.run_pending(config), 2)
+        finally:
+            del app.mail.connect
+
+        # both down one connection
+        self.assertEqual(len(connections), 1)
+        self.assertEqual([ message.subject for message in sent ], ["Hello", "Again"])
+        self.assertEqual(sent[0].recipients, [('Sicnarf Gnivri', 'test@localhost')])
+        self.assertEqual((sent[0].html, sent[0].cc, sent[0].reply_to, sent[0].extra_headers),
+            ("<p>Hi there</p>", ['cc@localhost'], "reply@localhost", { 'X-Test': 'yes' }))
+        self.assertEqual(sent[0].msgId, msg.msgId)
+        self.assertEqual([ (a.filename, a.data) for a in sent[0].attachments ], [("cv.txt", b"My CV")])
+
+        # rather than losing anything it doesn't know about
+        with app.app.app_context():
+            msg = flask_mail.Message(subject="Hello", recipients=['test@localhost'])
+        msg.alts = { 'text': "Hi" }
+        with self.assertRaises(ValueError):
+            outbox.send(config, msg)
+
+    def test_outbox_failures(self):
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite'), 'MAIL_PER_CONNECTION': 1 }
+        sent = []
+
+        # "bad" is rejected, and after "stop" we can't log in any more
+        class Connection:
+            def __enter__(self):
+                if sent and sent[-1] == "stop":
+                    raise smtplib.SMTPAuthenticationError(535, b"Authentication failed")
+                return self
+            def __exit__(self, *args):
+                pass
+            def send(self, message):
+                if message.subject == "bad":
+                    raise smtplib.SMTPDataError(554, b"Message rejected")
+                sent.append(message.subject)
+
+        app.mail.connect = Connection
+        try:
+            with app.app.app_context():
+                for subject in ["ok", "bad", "stop", "later"]:
+                    outbox.send(config, flask_mail.Message(subject=subject, body="Hi",
+                        sender="cv@democracyclub.org.uk", recipients=['test@localhost']))
+            self.assertEqual(jobqueue.run_pending(config), 4)
+        finally:
+            del app.mail.connect
+
+        self.assertEqual(sent, ["ok", "stop"])
+        # only the one which never went is tried again
+        waiting = localdb.connect(config, jobqueue.SCHEMA).execute("SELECT payload FROM jobs").fetchall()
+        self.assertEqual([ json.loads(row['payload'])['subject'] for row in waiting ], ["later"])
+
+
+class BulkMailTestCase(unittest.TestCase):
+
+    def test_send_all(self):
+        connections = []
+        refused = 'frabcus+refused@fastmail.fm'
+
+        # a connection which drops the first time the second mail is sent
+        class Connection:
+            def __enter__(self):
+                connections.append([])
+                return self
+            def __exit__(self, *args):
+                pass
+            def send(self, message):
+                if message.recipients == [refused]:
+                    raise smtplib.SMTPRecipientsRefused({ refused: (550, b"No such user") })
+                if message.subject == "1" and len(connections) == 1:
+                    raise smtplib.SMTPServerDisconnected()
+                connections[-1].append(message.subject)
+
+        class Mail:
+            def connect(self):
+                return Connection()
+
+        sent = []
+        batches = []
+        with app.app.app_context():
+            messages = [ flask_mail.Message(subject=str(i), recipients=[refused if i == 3 else 'frabcus@fastmail.fm'])
+                for i in range(6) ]
+            failures = bulkmail.send_all({ 'MAIL_PER_CONNECTION': 2 }, Mail(), messages,
+                sent=lambda message: sent.append(message.subject),
+                sent_batch=lambda messages: batches.append([ message.subject for message in messages ]))
+
+        self.assertEqual(sent, ["0", "1", "2", "4", "5"])
+        self.assertEqual(connections, [["0"], ["1", "2"], ["4"], ["5"]])
+        self.assertEqual(batches, connections)
+        self.assertEqual([ message.subject for message, error in failures ], ["3"])
+
+    def test_sent_fails(self):
+        sent = []
+
+        class Connection:
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+            def send(self, message):
+                sent.append(message.subject)
+
+        class Mail:
+            def connect(self):
+                return Connection()
+
+        # e.g. recording it in S3 fails
+        def record(message):
+            raise ConnectionError()
+
+        batches = []
+        with app.app.app_context():
+            messages = [ flask_mail.Message(subject=str(i), recipients=['frabcus@fastmail.fm']) for i in range(3) ]
+            with self.assertRaises(ConnectionError):
+                bulkmail.send_all({}, Mail(), messages, sent=record, sent_batch=batches.append)
+
+        # not sent again, as if the connection had broken
+        self.assertEqual(sent, ["0"])
+        self.assertEqual([ [ message.subject for message in batch ] for batch in batches ], [["0"]])
+
+
+class RefreshTestCase(unittest.TestCase):
+
+    def test_stale_while_revalidate(self):
+        calls = []
+
+        @refresh.memoize(app.app.config, app.cache, 0)
+        def slow(x):
+            calls.append(x)
+            return len(calls)
+
+        # unique, in case the cache is shared with earlier runs
+        arg = str(time.time())
+
+        # first call has to wait for the value
+        self.assertEqual(slow(arg), 1)
+        # later ones get the old value, while it is rebuilt in background
+        self.assertEqual(slow(arg), 1)
+        for i in range(50):
+            if app.cache.get(slow.make_key(arg))[0] == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(slow(arg), 2)
+
+    def test_lock(self):
+        config = { 'LOCAL_DB_PATH': os.path.join(tempfile.mkdtemp(), 'test.sqlite') }
+        owner = refresh._lock_other_processes(config, "key")
+        self.assertIsNotNone(owner)
+        self.assertIsNone(refresh._lock_other_processes(config, "key"))
+
+        # only the owner can unlock it
+        refresh._unlock_other_processes(config, "key", "someone else")
+        self.assertIsNone(refresh._lock_other_processes(config, "key"))
+        refresh._unlock_other_processes(config, "key", owner)
+        owner = refresh._lock_other_processes(config, "key")
+        self.assertIsNotNone(owner)
+
+        # one left by a crashed process runs out
+        localdb.connect(config).execute("UPDATE refresh_locks SET expires = 0")
+        self.assertIsNotNone(refresh._lock_other_processes(config, "key"))
 
 
 if __name__ == '__main__':
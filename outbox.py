@@ -0,0 +1,116 @@
+# Emails waiting to be sent.
+
+# Web requests queue their emails here and return straight away, rather
+# than waiting for the mail server. They are kept in the job queue (see
+# jobqueue.py), so they survive restarts, and one which fails to send is
+# tried again later, with its attempts and last error in the jobs table.
+# The worker sends all the waiting ones at once with bulkmail.send_all, so
+# they share SMTP connections. When TESTING they are sent straight away,
+# so tests can record them.
+
+import base64
+import smtplib
+
+import flask_mail
+
+import app
+import bulkmail
+import jobqueue
+
+# Every attribute of flask_mail.Message we keep, which is all of them
+MESSAGE_FIELDS = ['subject', 'recipients', 'body', 'html', 'sender', 'cc', 'bcc',
+    'attachments', 'reply_to', 'date', 'charset', 'extra_headers', 'mail_options',
+    'rcpt_options', 'msgId']
+
+# Takes the app config and a flask_mail.Message, and queues it to be sent.
+def send(config, msg):
+    jobqueue.enqueue(config, "send_mail", _to_payload(msg))
+
+# Raises an exception if the message has anything we wouldn't keep, e.g.
+# from a newer version of Flask-Mail, rather than send it without it.
+def _to_payload(msg):
+    unsupported = set(vars(msg)) - set(MESSAGE_FIELDS)
+    if unsupported:
+        raise ValueError("can't queue mail with " + ", ".join(sorted(unsupported)))
+
+    payload = { field: getattr(msg, field) for field in MESSAGE_FIELDS }
+    payload['attachments'] = [ {
+            'filename': attachment.filename,
+            'content_type': attachment.content_type,
+            'data': base64.b64encode(_bytes(attachment.data)).decode('ascii'),
+            'disposition': attachment.disposition,
+            'headers': attachment.headers
+        } for attachment in msg.attachments ]
+    return payload
+
+def _bytes(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+# (name, email) pairs come back from JSON as lists
+def _address(address):
+    if isinstance(address, list):
+        return tuple(address)
+    return address
+
+def _from_payload(payload):
+    msg = flask_mail.Message(subject=payload['subject'],
+            recipients=[ _address(recipient) for recipient in payload['recipients'] ],
+            body=payload['body'],
+            html=payload['html'],
+            sender=_address(payload['sender']),
+            cc=[ _address(recipient) for recipient in payload['cc'] ],
+            bcc=[ _address(recipient) for recipient in payload['bcc'] ],
+            attachments=[ flask_mail.Attachment(filename=attachment['filename'],
+                    content_type=attachment['content_type'],
+                    data=base64.b64decode(attachment['data']),
+                    disposition=attachment['disposition'],
+                    headers=attachment['headers'])
+                for attachment in payload['attachments'] ],
+            reply_to=_address(payload['reply_to']),
+            date=payload['date'],
+            charset=payload['charset'],
+            extra_headers=payload['extra_headers'],
+            mail_options=payload['mail_options'],
+            rcpt_options=payload['rcpt_options']
+          )
+    # the same one each time we try, so it can be spotted if sent twice
+    msg.msgId = payload['msgId']
+    return msg
+
+# Is it no use trying to send the message again, e.g. the address was refused?
+def _final(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+@jobqueue.batch_handler("send_mail")
+def _send_mail_jobs(config, payloads):
+    finished = set()
+    # id of message -> description of the error, for those to try again
+    errors = {}
+
+    def sent(message):
+        finished.add(id(message))
+
+    def failed(message, error):
+        finished.add(id(message))
+        if _final(error):
+            print("mail refused, not sending:", error)
+        else:
+            errors[id(message)] = str(error)
+
+    with app.app.app_context():
+        messages = [ _from_payload(payload) for payload in payloads ]
+        try:
+            bulkmail.send_all(config, app.mail, messages, sent=sent, failed=failed)
+        except Exception as e:
+            # e.g. we can't log in to the mail server any more; the rest are
+            # tried later, but not any which had already gone
+            print("sending mail stopped part way:", e)
+            for message in messages:
+                if id(message) not in finished:
+                    errors[id(message)] = str(e)
+
+    return [ errors.get(id(message)) for message in messages ]
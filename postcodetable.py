@@ -0,0 +1,103 @@
+# Local lookup table from postcode to Westminster constituency.
+
+# Made by bin/make-postcode-table.py from the ONS Postcode Directory, so
+# lookup_postcode works without waiting for (or even reaching) the
+# Democracy Club elections API.
+#
+# The file is sorted fixed width records, which we memory map and binary
+# search, so it is shared between worker processes and costs nothing to
+# open. Format:
+#   MAGIC
+#   header - number of constituencies, number of postcodes, length of JSON
+#   JSON list of [identifier, name] of each constituency
+#   records - canonical postcode (no spaces, padded with spaces) and the
+#             index of its constituency in the JSON list
+
+import os
+import mmap
+import json
+import struct
+import threading
+
+MAGIC = b"MPCVPC1\n"
+HEADER = struct.Struct("<III")
+POSTCODE_LENGTH = 7
+RECORD = struct.Struct("<7sH")
+
+# path -> (mmap, constituencies, offset of records, number of records)
+_open_tables = {}
+_open_lock = threading.Lock()
+
+def _canon(postcode):
+    return postcode.upper().replace(" ", "")
+
+# Takes a filename and an iterable of (postcode, constituency identifier,
+# constituency name). Writes the table, replacing any old one atomically.
+def write(path, postcodes):
+    constituencies = {}
+    records = []
+    for postcode, identifier, name in postcodes:
+        postcode = _canon(postcode).encode('ascii')
+        if len(postcode) > POSTCODE_LENGTH:
+            continue
+        index = constituencies.setdefault(identifier, (len(constituencies), name))[0]
+        records.append((postcode.ljust(POSTCODE_LENGTH), index))
+    records.sort()
+
+    constituency_list = [ [identifier, name] for identifier, (index, name) in sorted(constituencies.items(), key=lambda x: x[1][0]) ]
+    constituency_json = json.dumps(constituency_list).encode('utf-8')
+
+    temp_path = path + ".new"
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(len(constituency_list), len(records), len(constituency_json)))
+        f.write(constituency_json)
+        for postcode, index in records:
+            f.write(RECORD.pack(postcode, index))
+    os.replace(temp_path, path)
+
+    return len(records)
+
+def _open(path):
+    with _open_lock:
+        # reopen if the file has been replaced
+        stat = os.stat(path)
+        if path in _open_tables and _open_tables[path][0] == (stat.st_ino, stat.st_mtime):
+            return _open_tables[path][1]
+
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(MAGIC)] != MAGIC:
+            raise Exception("Not a postcode table: " + path)
+        constituency_count, record_count, json_length = HEADER.unpack_from(data, len(MAGIC))
+        json_start = len(MAGIC) + HEADER.size
+        constituencies = json.loads(data[json_start:json_start + json_length].decode('utf-8'))
+
+        table = (data, constituencies, json_start + json_length, record_count)
+        _open_tables[path] = ((stat.st_ino, stat.st_mtime), table)
+        return table
+
+# Takes the app config (for POSTCODE_TABLE_PATH) and a postcode. Returns a
+# pair of the constituency's identifier and name, or None if the postcode
+# isn't in the table, or there is no table.
+def lookup(config, postcode):
+    path = config.get('POSTCODE_TABLE_PATH')
+    if not path or not os.path.exists(path):
+        return None
+
+    data, constituencies, offset, count = _open(path)
+    wanted = _canon(postcode).encode('ascii', 'replace').ljust(POSTCODE_LENGTH)
+
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        postcode_at, index = RECORD.unpack_from(data, offset + middle * RECORD.size)
+        if postcode_at < wanted:
+            low = middle + 1
+        elif postcode_at > wanted:
+            high = middle
+        else:
+            identifier, name = constituencies[index]
+            return identifier, name
+
+    return None
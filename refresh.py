@@ -0,0 +1,146 @@
+# Caching which keeps serving the last good value while it is rebuilt.
+
+# Like Flask-Caching's memoize, but when an entry times out the old value
+# is still returned, and one background thread works out the new one.
+# So only the very first request waits for the slow data loaders, and
+# lots of requests arriving at once don't all rebuild the same thing.
+
+import time
+import uuid
+import hashlib
+import functools
+import threading
+import traceback
+import collections
+
+import localdb
+
+# How long to keep values we're not refreshing, just in case
+STALE_TIMEOUT = 60 * 60 * 24
+
+# Longest we expect a rebuild to take; after this, another process can try
+LOCK_TIMEOUT = 60 * 5
+
+# Which process is rebuilding each key. In the local database, as adding
+# to the cache isn't atomic. So if the cache is shared between machines,
+# each machine may rebuild a value once.
+LOCKS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS refresh_locks (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+# one lock per key, so threads in this process take turns
+_local_locks = collections.defaultdict(threading.Lock)
+
+# Decorator, use like @cache.memoize(timeout). Takes the app config (for
+# the local database), the Flask-Caching cache to store values in (so they
+# are shared between workers if it is), and how many seconds a value is
+# fresh for. Optionally, version is a function taking
+# the same arguments which quickly returns something that changes when the
+# value is out of date (e.g. keyindex.version), to refresh it sooner.
+def memoize(config, cache, timeout, version=None):
+    def decorator(f):
+        name = f.__module__ + "." + f.__name__
+
+        def make_key(*args):
+            return "refresh:" + name + ":" + hashlib.md5(repr(args).encode('utf-8')).hexdigest()
+
+        def current_version(args):
+            if version is None:
+                return None
+            return version(*args)
+
+        def rebuild(key, args):
+            # get the version first, so changes while building aren't missed
+            built_version = current_version(args)
+            value = f(*args)
+            cache.set(key, (value, time.time(), built_version), timeout=STALE_TIMEOUT)
+            return value
+
+        def rebuild_in_background(key, args, owner):
+            try:
+                rebuild(key, args)
+            except Exception:
+                print("background refresh of", name, "failed, still using old value")
+                traceback.print_exc()
+            finally:
+                _unlock(config, key, owner)
+
+        @functools.wraps(f)
+        def wrapper(*args):
+            key = make_key(*args)
+            entry = cache.get(key)
+
+            if entry is None:
+                return _first_build(config, cache, key, lambda: rebuild(key, args))
+
+            value, built_at, built_version = entry
+            stale = time.time() - built_at > timeout or built_version != current_version(args)
+            if stale:
+                owner = _lock(config, key)
+                if owner is not None:
+                    print("refreshing in background", name)
+                    threading.Thread(target=rebuild_in_background, args=(key, args, owner), daemon=True).start()
+            return value
+
+        wrapper.make_key = make_key
+        return wrapper
+    return decorator
+
+# Nothing cached yet, so we have to wait. But if someone else is already
+# building it, wait for them instead of doing it again.
+def _first_build(config, cache, key, build):
+    with _local_locks[key]:
+        deadline = time.time() + LOCK_TIMEOUT
+        owner = None
+        while True:
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+            owner = _lock_other_processes(config, key)
+            # if they're taking too long, build it anyway
+            if owner is not None or time.time() > deadline:
+                break
+            time.sleep(0.1)
+
+        try:
+            return build()
+        finally:
+            if owner is not None:
+                _unlock_other_processes(config, key, owner)
+
+# Try to become the only rebuilder of the key. Returns who we are, to
+# pass to _unlock, or None if someone else is rebuilding it.
+def _lock(config, key):
+    if not _local_locks[key].acquire(blocking=False):
+        return None
+    owner = _lock_other_processes(config, key)
+    if owner is None:
+        _local_locks[key].release()
+    return owner
+
+def _unlock(config, key, owner):
+    _unlock_other_processes(config, key, owner)
+    _local_locks[key].release()
+
+# Takes the lock in the local database, unless another process has it and
+# hasn't taken longer than LOCK_TIMEOUT (e.g. because it crashed). Returns
+# a unique owner, or None.
+def _lock_other_processes(config, key):
+    conn = localdb.connect(config, LOCKS_SCHEMA)
+    owner = uuid.uuid4().hex
+    now = time.time()
+    with localdb.transaction(conn):
+        conn.execute("DELETE FROM refresh_locks WHERE key = ? AND expires < ?", (key, now))
+        cursor = conn.execute("INSERT OR IGNORE INTO refresh_locks (key, owner, expires) VALUES (?, ?, ?)",
+            (key, owner, now + LOCK_TIMEOUT))
+    if cursor.rowcount != 1:
+        return None
+    return owner
+
+# Releases the lock, only if it is still ours.
+def _unlock_other_processes(config, key, owner):
+    localdb.connect(config, LOCKS_SCHEMA).execute("DELETE FROM refresh_locks WHERE key = ? AND owner = ?", (key, owner))
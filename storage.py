@@ -0,0 +1,218 @@
+# Where CVs, thumbnails and our other files are kept.
+
+# Normally that is S3. Set STORAGE_BACKEND=local to keep them in a directory
+# instead (STORAGE_DIR, default tmp/storage), so the whole site can run on
+# one machine without a network, e.g. for development, load tests and
+# benchmarks. Public local files are served by the app itself, see
+# stored_file in app.py; STORAGE_URL is the URL they are under.
+#
+# Files are named like S3 keys, e.g. "cvs/123/2019-11-01T10:00:00-cv.pdf".
+# Listings return StoredFile, with last_modified as a naive UTC datetime.
+
+import os
+import io
+import time
+import shutil
+import tempfile
+import datetime
+import threading
+import collections
+
+import boto.s3.connection
+import boto.s3.key
+import boto.utils
+
+StoredFile = collections.namedtuple('StoredFile', ['name', 'last_modified', 'url'])
+
+# Files bigger than this are sent to S3 in parts of this size (S3 needs
+# parts of at least 5Mb), so a failed part can be retried on its own.
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# Times to try each part before giving up on the whole upload
+S3_PART_ATTEMPTS = 3
+
+# Returns the storage to use for the app config.
+def get(config):
+    if config.get('STORAGE_BACKEND', 's3') == 'local':
+        return LocalStorage(config.get('STORAGE_DIR', 'tmp/storage'),
+            config.get('STORAGE_URL', 'http://localhost:5000/storage/'))
+    return S3Storage(config)
+
+
+###################################################################
+# Amazon S3
+
+# S3 connection and bucket handles, kept per thread and per process, as
+# boto connections can't safely be shared between them.
+_s3 = threading.local()
+
+def _get_s3_bucket(config):
+    if getattr(_s3, 'pid', None) != os.getpid():
+        _s3.pid = os.getpid()
+        _s3.conn = boto.s3.connection.S3Connection(
+            config.get('S3_ACCESS_KEY_ID'),
+            config.get('S3_SECRET_ACCESS_KEY')
+        )
+        _s3.buckets = {}
+
+    bucket_name = config.get('S3_BUCKET_NAME')
+    if bucket_name not in _s3.buckets:
+        # don't check the bucket exists, which would cost a request; if it
+        # doesn't, the first real call on it fails instead
+        _s3.buckets[bucket_name] = _s3.conn.get_bucket(bucket_name, validate=False)
+    return _s3.buckets[bucket_name]
+
+class S3Storage:
+    def __init__(self, config):
+        self.bucket = _get_s3_bucket(config)
+        self.multipart_threshold = int(config.get('S3_MULTIPART_THRESHOLD', S3_MULTIPART_THRESHOLD))
+
+    def _stored_file(self, key):
+        return StoredFile(key.name, boto.utils.parse_ts(key.last_modified), self.url(key.name))
+
+    # Takes a name, and the contents as bytes, a string or a binary file
+    # object, which is read from where it is and never all into memory.
+    # Public files can be downloaded by anyone from their url.
+    def write(self, name, contents, content_type=None, public=False):
+        headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        policy = 'public-read' if public else None
+
+        if not hasattr(contents, 'read'):
+            key = boto.s3.key.Key(self.bucket)
+            key.key = name
+            key.set_contents_from_string(contents, headers=headers, policy=policy)
+            return
+
+        start = contents.tell()
+        size = contents.seek(0, io.SEEK_END) - start
+        contents.seek(start)
+        if size > self.multipart_threshold:
+            self._write_multipart(name, contents, size, headers, policy)
+        else:
+            key = boto.s3.key.Key(self.bucket)
+            key.key = name
+            key.set_contents_from_file(contents, headers=headers, policy=policy)
+
+    def _write_multipart(self, name, contents, size, headers, policy):
+        upload = self.bucket.initiate_multipart_upload(name, headers=headers, policy=policy)
+        try:
+            part_number = 1
+            while size > 0:
+                part_size = min(size, self.multipart_threshold)
+                self._upload_part(upload, contents, part_number, part_size)
+                size -= part_size
+                part_number += 1
+            upload.complete_upload()
+        except:
+            upload.cancel_upload()
+            raise
+
+    def _upload_part(self, upload, contents, part_number, part_size):
+        start = contents.tell()
+        for attempt in range(S3_PART_ATTEMPTS):
+            try:
+                upload.upload_part_from_file(contents, part_number, size=part_size)
+                return
+            except Exception as e:
+                if attempt == S3_PART_ATTEMPTS - 1:
+                    raise
+                print("failed to upload part", part_number, "of", upload.key_name, "trying again:", e)
+                contents.seek(start)
+                time.sleep(2 ** attempt)
+
+    # Returns a binary file object to read the file from, or None if
+    # there is no such file.
+    def open(self, name):
+        return self.bucket.get_key(name)
+
+    def read(self, name):
+        return self.bucket.get_key(name).get_contents_as_string()
+
+    # Returns every file whose name starts with the prefix, in no order.
+    def list(self, prefix):
+        for key in self.bucket.list(prefix):
+            yield self._stored_file(key)
+
+    def url(self, name):
+        key = boto.s3.key.Key(self.bucket)
+        key.key = name
+        return key.generate_url(expires_in=0, query_auth=False)
+
+
+###################################################################
+# Local directory
+
+# Public and private files are in separate directories, so we never
+# serve a private one.
+class LocalStorage:
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url
+
+    def _path(self, name, public):
+        parts = name.split("/")
+        assert ".." not in parts and "" not in parts[:-1]
+        return os.path.join(self.directory, "public" if public else "private", *parts)
+
+    def _existing_path(self, name):
+        for public in [True, False]:
+            path = self._path(name, public)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def write(self, name, contents, content_type=None, public=False):
+        path = self._path(name, public)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # replace atomically, so readers never see half a file, and two
+        # processes writing at once don't mix up their files
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".new")
+        with os.fdopen(fd, 'wb') as f:
+            if hasattr(contents, 'read'):
+                shutil.copyfileobj(contents, f)
+            else:
+                if isinstance(contents, str):
+                    contents = contents.encode('utf-8')
+                f.write(contents)
+        # mkstemp makes it private to us
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+        # if it was there with the other visibility, it isn't any more
+        other_path = self._path(name, not public)
+        if os.path.exists(other_path):
+            os.remove(other_path)
+
+    def open(self, name):
+        path = self._existing_path(name)
+        if path is None:
+            return None
+        return open(path, 'rb')
+
+    def read(self, name):
+        with open(self._existing_path(name), 'rb') as f:
+            return f.read()
+
+    def list(self, prefix):
+        for public in [True, False]:
+            top = os.path.join(self.directory, "public" if public else "private")
+            # only walk the directory the prefix is in
+            start = os.path.join(top, *prefix.split("/")[:-1])
+            for directory, subdirectories, filenames in os.walk(start):
+                for filename in filenames:
+                    if filename.endswith(".new"):
+                        continue
+                    path = os.path.join(directory, filename)
+                    name = os.path.relpath(path, top).replace(os.sep, "/")
+                    if name.startswith(prefix):
+                        last_modified = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+                        yield StoredFile(name, last_modified, self.url(name))
+
+    def url(self, name):
+        return self.base_url + name
+
+    # Returns the directory and relative path of a public file, for
+    # flask.send_from_directory.
+    def public_path(self, name):
+        return os.path.join(self.directory, "public"), name
@@ -0,0 +1,94 @@
+# Index of who is subscribed to updates, kept in the local database so
+# every worker process shares it.
+
+# Subscriptions are files in storage named "updates/<email>", containing
+# the postcode (see lookups.updates_join). New ones are added to this index
+# as they happen, and it is occasionally reconciled against a full listing
+# (see lookups.reconcile_subscribers), like keyindex.py. So checking if
+# someone is subscribed is a lookup in a local table, not a storage listing.
+
+import time
+import datetime
+
+import localdb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    email TEXT PRIMARY KEY,
+    postcode TEXT,
+    last_modified TEXT NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subscribers_status (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    reconciled_at REAL,
+    lease_until REAL NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO subscribers_status (id) VALUES (0);
+"""
+
+def _connect(config):
+    return localdb.connect(config, SCHEMA)
+
+# Returns how many seconds ago the index was last reconciled, or None if
+# it never has been.
+def reconciled_age(config):
+    row = _connect(config).execute("SELECT reconciled_at FROM subscribers_status").fetchone()
+    if row['reconciled_at'] is None:
+        return None
+    return time.time() - row['reconciled_at']
+
+# Try to become the one process which reconciles the index. Returns True if
+# we got it, in which case nobody else will for lease seconds.
+def claim_reconcile(config, lease):
+    now = time.time()
+    cursor = _connect(config).execute("UPDATE subscribers_status SET lease_until = ? WHERE lease_until < ?",
+        (now + lease, now))
+    return cursor.rowcount == 1
+
+# Gives up our claim to reconcile the index, so another process can try
+# straight away.
+def release_reconcile(config):
+    _connect(config).execute("UPDATE subscribers_status SET lease_until = 0")
+
+# Records a subscription (or a new last sent date for one) just saved.
+def add(config, email, postcode, last_modified):
+    _connect(config).execute("""INSERT OR REPLACE INTO subscribers (email, postcode, last_modified, indexed_at)
+        VALUES (?, ?, ?, ?)""", (email, postcode, last_modified.isoformat(), time.time()))
+
+# Records the postcodes of subscriptions we've read from storage, a
+# dictionary from email to postcode.
+def set_postcodes(config, postcodes):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        conn.executemany("UPDATE subscribers SET postcode = ? WHERE email = ?",
+            [ (postcode, email) for email, postcode in postcodes.items() ])
+
+# Replaces the index with a full listing of storage, a dictionary from
+# email to last modified time. Postcodes we already know are kept, unless
+# the file has changed (e.g. they joined again from another machine), and
+# so is anything added since the listing began, as the listing may have
+# missed it.
+def replace(config, entries, listing_started):
+    conn = _connect(config)
+    with localdb.transaction(conn):
+        conn.executemany("""INSERT INTO subscribers (email, last_modified, indexed_at) VALUES (?, ?, ?)
+            ON CONFLICT (email) DO UPDATE SET
+                postcode = CASE WHEN last_modified = excluded.last_modified THEN postcode ELSE NULL END,
+                last_modified = excluded.last_modified, indexed_at = excluded.indexed_at
+            WHERE indexed_at < excluded.indexed_at""",
+            [ (email, last_modified.isoformat(), listing_started) for email, last_modified in entries.items() ])
+        conn.execute("DELETE FROM subscribers WHERE indexed_at < ?", (listing_started,))
+        conn.execute("UPDATE subscribers_status SET reconciled_at = ?, lease_until = 0", (time.time(),))
+
+# Is the email subscribed?
+def contains(config, email):
+    return _connect(config).execute("SELECT 1 FROM subscribers WHERE email = ?", (email,)).fetchone() is not None
+
+# Returns a list of every subscriber, as dictionaries with email, postcode
+# (None if we don't know it yet) and last_modified, oldest first.
+def all_subscribers(config):
+    rows = _connect(config).execute("SELECT email, postcode, last_modified FROM subscribers ORDER BY last_modified").fetchall()
+    return [ { 'email': row['email'], 'postcode': row['postcode'],
+               'last_modified': datetime.datetime.fromisoformat(row['last_modified']) }
+             for row in rows ]
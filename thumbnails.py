@@ -0,0 +1,199 @@
+# Making thumbnail images of CVs, as they are uploaded (by the job queue's
+# worker, see jobqueue.py) and by cron.py.
+
+# There are two ways of making them, chosen by THUMBNAIL_RENDERER:
+#   phantomjs - a screenshot of the CV in the Google Docs viewer. Takes at
+#               least 10 seconds, and needs the network.
+#   local     - converts the CV to PDF with LibreOffice (soffice), and
+#               rasterises the first page with pdftoppm from Poppler. About
+#               a second, and works offline (with local storage).
+# Either way, when there are lots to do we make several at once, each in
+# its own process and temporary directory.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import traceback
+import multiprocessing
+import concurrent.futures
+
+import PIL.Image
+import PIL.ImageOps
+
+import jobqueue
+import lookups
+import storage
+
+# Width and height of thumbnails, the shape of A4
+THUMBNAIL_SIZE = (400, 566)
+
+THUMBNAIL_DEFAULTS = {
+    # how many to make at once
+    'THUMBNAIL_WORKERS': 4,
+    # seconds before giving up on one
+    'THUMBNAIL_TIMEOUT': 120
+}
+
+SCREENSHOT_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "screenshot.js")
+
+def _setting(config, name):
+    return int(config.get(name, THUMBNAIL_DEFAULTS[name]))
+
+# Takes a CV, with fields as in lookups._hash_by_prefix, and makes a JPEG
+# thumbnail of it in filename. Raises an exception if it goes wrong.
+def render(config, cv, filename):
+    if config.get('THUMBNAIL_RENDERER', 'phantomjs') == 'local':
+        _render_local(config, cv, filename)
+    else:
+        _render_phantomjs(config, cv, filename)
+
+def _render_phantomjs(config, cv, filename):
+    with tempfile.TemporaryDirectory() as directory:
+        screenshot = os.path.join(directory, "screenshot.png")
+        subprocess.run(["phantomjs", SCREENSHOT_JS, cv['url'], screenshot],
+            check=True, timeout=_setting(config, 'THUMBNAIL_TIMEOUT'))
+        _save_jpeg(PIL.Image.open(screenshot), filename)
+
+def _render_local(config, cv, filename):
+    timeout = _setting(config, 'THUMBNAIL_TIMEOUT')
+    with tempfile.TemporaryDirectory() as directory:
+        extension = os.path.splitext(cv['name'])[1].lower()
+        source = os.path.join(directory, "cv" + extension)
+        stored = storage.get(config).open(cv['name'])
+        try:
+            with open(source, 'wb') as f:
+                shutil.copyfileobj(stored, f)
+        finally:
+            stored.close()
+
+        pdf = source
+        if extension != ".pdf":
+            # own profile directory, so several can run at once
+            subprocess.run(["soffice", "-env:UserInstallation=file://" + os.path.join(directory, "profile"),
+                    "--headless", "--convert-to", "pdf", "--outdir", directory, source],
+                check=True, timeout=timeout, stdout=subprocess.DEVNULL)
+            pdf = os.path.join(directory, "cv.pdf")
+            if not os.path.exists(pdf):
+                raise Exception("LibreOffice couldn't convert " + cv['name'] + " to PDF")
+
+        subprocess.run(["pdftoppm", "-f", "1", "-l", "1", "-singlefile", "-png",
+                "-scale-to-x", str(THUMBNAIL_SIZE[0]), "-scale-to-y", "-1", pdf, os.path.join(directory, "page")],
+            check=True, timeout=timeout)
+        page = PIL.Image.open(os.path.join(directory, "page.png"))
+        # pages which aren't A4 lose a bit of the bottom
+        _save_jpeg(PIL.ImageOps.fit(page, THUMBNAIL_SIZE, centering=(0.5, 0)), filename)
+
+def _save_jpeg(img, filename):
+    # remove alpha channel, which JPEG doesn't support
+    img = img.convert("RGB")
+    # JPEGs are smaller
+    img.save(filename, "JPEG", optimize=True)
+
+# Takes a JPEG thumbnail made by render, and makes each of its variants in
+# the directory. Returns a list of (filename, name in storage, format).
+def make_variants(filename, thumb_name, directory):
+    img = PIL.Image.open(filename)
+    variants = []
+    for format in lookups.THUMBNAIL_FORMATS:
+        for width in lookups.THUMBNAIL_WIDTHS:
+            variant_name = lookups.thumbnail_variant_name(thumb_name, width, format)
+            if variant_name == thumb_name:
+                continue
+            height = round(img.height * width / img.width)
+            variant_filename = os.path.join(directory, "{}.{}".format(width, format))
+            img.resize((width, height), PIL.Image.LANCZOS).save(variant_filename,
+                "WEBP" if format == "webp" else "JPEG", optimize=True)
+            variants.append((variant_filename, variant_name, format))
+    return variants
+
+# Takes a CV, with fields as in lookups._hash_by_prefix, and makes and
+# stores its thumbnail, and its other sizes and formats if it can. If the
+# CV has a 'candidate' field (as lookups.lookup_candidate), it is used instead
+# of looking them up. Returns None, or a description of the error if it failed.
+def make_thumbnail(config, cv):
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "thumbnail.jpg")
+            render(config, cv, filename)
+            thumb_name = lookups.thumbnail_name(cv)
+            lookups.add_thumb(config, filename, thumb_name, extension="jpg", candidate=cv.get('candidate'))
+            # if these fail, we still have the main one, and cron.py makes
+            # them from it later
+            try:
+                lookups.add_thumb_variants(config, thumb_name, make_variants(filename, thumb_name, directory),
+                    candidate=cv.get('candidate'))
+            except Exception:
+                print("failed to make thumb variants for person", cv['person_id'])
+                traceback.print_exc()
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+# Takes a thumbnail, with fields as in lookups._hash_by_prefix, which
+# doesn't have its other sizes and formats yet (e.g. it was made before
+# there were any), and makes them from it. Much quicker than rendering the
+# CV again. Returns None, or a description of the error if it failed.
+def make_missing_variants(config, thumb):
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "thumbnail.jpg")
+            stored = storage.get(config).open(thumb['name'])
+            try:
+                with open(filename, 'wb') as f:
+                    shutil.copyfileobj(stored, f)
+            finally:
+                stored.close()
+            lookups.add_thumb_variants(config, thumb['name'], make_variants(filename, thumb['name'], directory))
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+# Queued by lookups.add_cv when a CV is uploaded. If it fails, the job
+# queue tries again later, and eventually cron.py's gen_thumbs reports it.
+# Too slow to wait for, even when the queue is eager.
+@jobqueue.handler("thumbnail", eager=False)
+def _make_thumbnail_job(config, payload):
+    cv = lookups.cv_needing_thumbnail(config, payload['person_id'])
+    if cv is None:
+        return
+    print("worker making thumb:", cv)
+    error = make_thumbnail(config, cv)
+    if error is not None:
+        raise Exception("Failed to make thumb for person " + str(cv["person_id"]) + "\n" + error)
+
+# Takes a list of CVs, and makes all their thumbnails, THUMBNAIL_WORKERS
+# at a time. Returns a list of (CV, error) pairs of any which failed.
+def make_thumbnails(config, cvs):
+    cvs = list(cvs)
+    if len(cvs) == 0:
+        return []
+
+    # look up the candidates here, so the worker processes don't each have
+    # to load them all
+    cvs = [ dict(cv, candidate=lookups.lookup_candidate(config, cv['person_id'])) for cv in cvs ]
+
+    # the worker processes need a copy which can be pickled
+    config = dict(config)
+    failures = []
+    # new processes rather than forks, as a fork would get copies of locks
+    # held by our other threads (e.g. refreshing caches), never released
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(cvs), _setting(config, 'THUMBNAIL_WORKERS')),
+            mp_context=context) as pool:
+        futures = { pool.submit(make_thumbnail, config, cv): cv for cv in cvs }
+        for future in concurrent.futures.as_completed(futures):
+            cv = futures[future]
+            try:
+                error = future.result()
+            except Exception:
+                # e.g. the worker process died
+                error = traceback.format_exc()
+            if error is None:
+                print("made thumb for person", cv['person_id'])
+            else:
+                print("failed to make thumb for person", cv['person_id'])
+                print(error)
+                failures.append((cv, error))
+
+    return failures